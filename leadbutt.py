@@ -1,39 +1,105 @@
 # -*- coding: UTF-8 -*-
 """
 Usage:
-  leadbutt [options]
+  leadbutt [options] [--config-file=FILE...] [--sink=URL...]
 
 Options:
   -h --help                   Show this screen.
-  -c FILE --config-file=FILE  Path to a YAML configuration file [default: config.yaml].
+  -c FILE --config-file=FILE  Path to a YAML configuration file, can be used multiple times
+                              [default: config.yaml].
   -i INTERVAL                 Interval, in ms, to wait between metric requests. Doubles as the backoff multiplier. [default: 50]
   -m MAX_INTERVAL             The maximum interval time to back off to, in ms [default: 4000]
   -p INT --period INT         Period length, in minutes [default: 1]
   -n INT                      Number of data points to try to get [default: 5]
+  --plan                      Estimate API calls, datapoints, duration and cost without calling AWS
+  --daemon                    Keep running, fetching metrics every period. SIGHUP reloads the config
+                              file.
+  --pid-file FILE             Write the process id here, e.g. for plumbum --watch to signal
+  --shard I/N                 Only fetch the I-th of N shares of the metrics, counting from 1
+  --processes N               Run N shards in separate processes, merging their output
+  --spool DIR                 Keep output in this directory while stdout is unavailable, and send it
+                              later
+  --spool-max-bytes BYTES     The most output to keep in the spool [default: 104857600]
+  --spool-max-age SECONDS     Drop spooled output older than this [default: 86400]
+  --drain-rate LINES          Lines per second to send from the spool once stdout is back
+                              [default: 1000]
+  --adaptive FILE             Learn how often each series gets new datapoints, keeping track in FILE
+                              (FILE.I-of-N for each shard), and poll sparse or empty series less
+                              often
+  --max-backoff SECONDS       The longest --adaptive waits to poll a series again [default: 3600]
+  --overlap MODE              What to do if the last run of this config is still going: allow it,
+                              skip this run, or takeover the queries it has not done yet
+                              [default: allow]
+  --lock-dir DIR              Where to keep --overlap lock and progress files, instead of the temp
+                              dir
+  --stream                    Start fetching metrics while the config file is still being read
+  --early                     Also output the current, incomplete period, and revise it on later
+                              runs
+  --revisions FILE            Keep track of the datapoints already output in FILE (FILE.I-of-N for
+                              each shard), and only output datapoints again if their values changed
+  --capture DIR               Record the responses from AWS in DIR, one gzipped segment per run
+  --replay DIR                Output the responses recorded in DIR as formatted by the config file,
+                              without calling AWS
+  --engine ENGINE             Fetch with boto, or with asyncio (Python 3.5+), which keeps many more
+                              requests in flight [default: boto]
+  --in-flight N               The most requests the asyncio engine keeps in flight [default: 500]
+  --cache-size ENTRIES        With multiple config files, how many CloudWatch responses to keep for
+                              queries they have in common [default: 10000]
+  --cache-ttl SECONDS         How long to keep them, instead of one period
+  --sink=URL                  Send output here instead of stdout, can be used multiple times. See
+                              below.
   -v                          Verbose
   --version                   Show version.
+
+Sinks:
+  stdout                      Graphite plaintext to stdout
+  graphite://HOST:PORT        Graphite plaintext over TCP
+  statsd://HOST:PORT          StatsD gauges over UDP
+  influxdb://HOST:PORT?db=DB  InfluxDB line protocol over HTTP
+  file:///PATH                Graphite plaintext appended to a file
+  serve://HOST:PORT           Serve the latest value of each series over HTTP, at /metrics for
+                              Prometheus and /metrics.json
+
+  Each sink sends from a queue of its own. Add query parameters to set
+  batch=LINES, flush=SECONDS, policy=block|drop when the queue is full,
+  queue=LINES and spool=DIR to spool lines the sink could not take.
 """
 from __future__ import unicode_literals
 
 from calendar import timegm
+from collections import OrderedDict
+from contextlib import contextmanager
 import datetime
+from fnmatch import fnmatchcase
+import importlib
+import itertools
+import json
+import operator
 import os.path
+import re
+import signal
 import sys
+import threading
 import time
 import ast
 
 from docopt import docopt
-import boto.ec2.cloudwatch
-import boto.logs
 from retrying import retry
 import yaml
 
 
 # emulate six.text_type based on https://docs.python.org/3/howto/pyporting.html#str-unicode
+# modules only some commands, sinks or options need, like the HTTP client and
+# server modules that pull in ssl and email, get imported where they are used
 if sys.version_info[0] >= 3:
+    import queue
+    from sys import intern
     text_type = str
+    string_types = (str,)
 else:
+    import Queue as queue
     text_type = unicode
+    string_types = (basestring,)
 
 __version__ = '0.9.5b4'
 
@@ -47,6 +113,95 @@ DEFAULT_OPTIONS = {
     'Count': 5,  # 5 periods
     'Formatter': 'cloudwatch.%(Namespace)s.%(dimension)s.%(MetricName)s.%(statistic)s.%(Unit)s'
 }
+# the default Formatter and the Functions available for Rollups
+DEFAULT_ROLLUP_FORMATTER = ('cloudwatch.%(Namespace)s.%(group)s.%(MetricName)s.%(statistic)s.'
+                            '%(function)s')
+ROLLUP_FUNCTIONS = {
+    'sum': sum,
+    'avg': lambda values: float(sum(values)) / len(values),
+    'min': min,
+    'max': max,
+    'count': len,
+}
+
+# the default Formatter for Derived metrics
+DEFAULT_DERIVED_FORMATTER = 'cloudwatch.%(Namespace)s.%(group)s.%(Name)s'
+# the functions Derived expressions can call, from derived_functions(), and
+# how many arguments each takes
+DERIVED_FUNCTIONS = {
+    'abs': 1,
+    'sqrt': 1,
+    'log': 1,
+    'min': 2,
+    'max': 2,
+    'rate': 1,
+    'moving_average': 2,
+}
+# the operators allowed in Derived expressions
+DERIVED_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+# Assumptions used by --plan to estimate a run without calling AWS
+PLAN_REQUEST_LATENCY = 0.1  # seconds per API round trip
+PLAN_LOG_STREAM_SLEEP = 0.5  # matches the rate limiting sleep between log streams
+# documented per-account request rate limits, in requests per second
+PLAN_RATE_LIMITS = {
+    'GetMetricStatistics': 400,
+    'DescribeLogStreams': 5,
+    'GetLogEvents': 10,
+}
+# USD per 1,000 requests; Logs API requests are not billed per request
+PLAN_REQUEST_COST = {
+    'GetMetricStatistics': 0.01,
+    'DescribeLogStreams': 0.0,
+    'GetLogEvents': 0.0,
+}
+PLAN_EXIT_CODE = 3  # the config can not finish within its period
+
+# --adaptive never waits longer than this to poll a series again, in seconds
+ADAPTIVE_MAX_BACKOFF = 60 * 60
+# CloudWatch returns at most this many datapoints per request
+MAX_DATAPOINTS = 1440
+
+# Defaults for the --spool output buffer
+SPOOL_MAX_BYTES = 100 * 1024 * 1024
+SPOOL_MAX_AGE = 24 * 60 * 60  # seconds
+SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+SPOOL_DRAIN_RATE = 1000  # lines per second
+SPOOL_DRAIN_BATCH = 500  # lines
+SPOOL_RETRY_INTERVAL = 10  # seconds before trying a failed sink again
+
+# Defaults for --sink outputs, each can be overridden with URL query parameters
+SINK_BATCH_SIZE = 500  # lines
+SINK_FLUSH_INTERVAL = 1.0  # seconds
+SINK_QUEUE_SIZE = 10000  # lines
+SINK_TIMEOUT = 10  # seconds
+SINK_PARAMETERS = ('batch', 'flush', 'policy', 'queue', 'spool')
+
+# How to connect to CloudWatch, for ConnectionPool, and the most connections
+# it keeps per service, region and credentials
+CLOUDWATCH_CONNECT = 'boto.ec2.cloudwatch:connect_to_region'
+POOL_MAX_SIZE = 10
+
+# Default size of the response cache shared by multiple config files
+CACHE_MAX_ENTRIES = 10000
+
+# Enhanced Monitoring log backends, as 'module:connect_function' strings so
+# they only get imported when used. Third party backends can register a
+# `leadbutt.log_backends` entry point; either way, the connect function takes
+# a region and returns an object like `boto.logs.layer1.CloudWatchLogsConnection`.
+LOG_BACKENDS = {
+    'cloudwatchlogs': 'boto.logs:connect_to_region',
+}
+DEFAULT_LOG_BACKEND = 'cloudwatchlogs'
+
 # catergory map to find what value describes the metrics
 LIST_CATEGORY_MAP = {
     "network": "interface",
@@ -54,6 +209,9 @@ LIST_CATEGORY_MAP = {
     "fileSys": "name",
     "processList": "name"
 }
+# statistics of list entries that identify rather than measure, so they are
+# not summed into the Other entry
+LIST_IDENTIFIERS = ("id", "parentID", "tgid")
 # graphite unit map for each value
 UNIT_MAP = {
     "cpuUtilization": {
@@ -144,22 +302,226 @@ UNIT_MAP = {
 }
 
 
+# what can go wrong reading a config file again, which a daemon survives
+CONFIG_ERRORS = (yaml.YAMLError, IOError, OSError, ImportError, KeyError, TypeError, ValueError)
+
+
+def load_config(config_file):
+    """Read configuration from a file, raising IOError or yaml.YAMLError if it can't."""
+    if config_file == '-':
+        return yaml.safe_load(sys.stdin)
+    with open(config_file) as fp:
+        return yaml.safe_load(fp)
+
+
 def get_config(config_file):
     """Get configuration from a file."""
-    def load(fp):
+    if config_file != '-' and not os.path.exists(config_file):
+        sys.stderr.write('ERROR: Must either run next to config.yaml or specify a config file.\n' + __doc__)
+        sys.exit(2)
+    try:
+        return load_config(config_file)
+    except yaml.YAMLError as e:
+        sys.stderr.write(text_type(e))
+        sys.exit(1)  # TODO document exit codes
+
+
+class _Replay(object):
+    """A file-like object that reads `head` before the rest of `fp`."""
+
+    def __init__(self, head, fp):
+        self.head = head
+        self.fp = fp
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fp.read(size)
+        if size < 0:
+            data, self.head = self.head + self.fp.read(), ''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+def _iter_yaml_config(fp):
+    loader = yaml.SafeLoader(fp)
+
+    def construct():
+        value = loader.construct_object(loader.compose_node(None, None), deep=True)
+        # forget what has been built so far, so memory use stays flat
+        loader.constructed_objects = {}
+        loader.recursive_objects = {}
+        return value
+
+    try:
+        loader.get_event()  # StreamStartEvent
+        if not loader.check_event(yaml.DocumentStartEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise yaml.YAMLError('the config must be a mapping')
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            section = construct()
+            if section == 'Metrics' and loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield section, construct()
+                loader.get_event()
+            else:
+                yield section, construct()
+    finally:
+        loader.dispose()
+
+
+def _iter_line_config(lines):
+    for line in lines:
+        if not line.strip():
+            continue
         try:
-            return yaml.load(fp)
-        except yaml.YAMLError as e:
-            sys.stderr.write(text_type(e))
-            sys.exit(1)  # TODO document exit codes
+            entry = json.loads(line)
+        except ValueError:
+            entry = yaml.safe_load(line)
+        if 'MetricName' in entry:
+            yield 'Metrics', entry
+        else:
+            for section, value in entry.items():
+                yield section, value
 
-    if config_file == '-':
-        return load(sys.stdin)
-    if not os.path.exists(config_file):
-        sys.stderr.write('ERROR: Must either run next to config.yaml or specify a config file.\n' + __doc__)
+
+def iter_config_stream(fp):
+    """
+    Read a config from `fp` a piece at a time, yielding (section, value)
+    pairs for each top level section, and ('Metrics', entry) for each
+    entry in Metrics.
+
+    Configs can be YAML, or have one JSON or YAML flow mapping per line:
+    lines with a MetricName are Metrics entries, and the keys of any other
+    line are sections, like Auth and Options.
+    """
+    first_line = fp.readline()
+    try:
+        is_lines = isinstance(json.loads(first_line), dict)
+    except ValueError:
+        is_lines = False
+    if is_lines:
+        return _iter_line_config(itertools.chain([first_line], fp))
+    return _iter_yaml_config(_Replay(first_line, fp))
+
+
+def iter_config(config_file):
+    """Like get_config(), but yields the config a piece at a time with iter_config_stream()."""
+    if config_file != '-' and not os.path.exists(config_file):
+        sys.stderr.write(
+            'ERROR: Must either run next to config.yaml or specify a config file.\n' + __doc__)
         sys.exit(2)
-    with open(config_file) as fp:
-        return load(fp)
+    fp = sys.stdin if config_file == '-' else open(config_file)
+    try:
+        for section, value in iter_config_stream(fp):
+            yield section, value
+    except yaml.YAMLError as e:
+        sys.stderr.write(text_type(e))
+        sys.exit(1)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def iter_entry_points(group):
+    """Iterate over the setuptools entry points registered for `group`."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return pkg_resources.iter_entry_points(group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+def load_plugin(group, name, registry):
+    """
+    Get the plugin called `name`, importing it only now that it is needed.
+
+    Built in plugins live in `registry` as either the object itself or a
+    'module:attribute' string. Anything else is looked up in the `group`
+    entry points, so third party packages can add their own.
+    """
+    if name in registry:
+        plugin = registry[name]
+        if isinstance(plugin, string_types):
+            module_name, attribute = plugin.split(':', 1)
+            plugin = getattr(importlib.import_module(module_name), attribute)
+            registry[name] = plugin
+        return plugin
+    for entry_point in iter_entry_points(group):
+        if entry_point.name == name:
+            registry[name] = entry_point.load()
+            return registry[name]
+    raise KeyError(name)
+
+
+class ConnectionPool(object):
+    """
+    Lends out boto connections, keyed by how to connect, the region and the
+    connection arguments, like credentials.
+
+    boto connections are not safe to share between threads, so each one is
+    lent to one user at a time::
+
+        with pool.connection('boto.ec2:connect_to_region', region) as conn:
+            conn.get_only_instances()
+
+    `connect` is a 'module:function' string, imported only when needed, or
+    a function; either way it is called with the region and arguments. A
+    connection that was given back keeps its HTTP keep-alive connections
+    open for the next user. There are at most `max_size` connections per
+    key, and users past that wait for one to be given back.
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE):
+        self.max_size = max_size
+        self.idle = {}
+        self.sizes = {}
+        self.condition = threading.Condition()
+
+    def get(self, connect, region, **kwargs):
+        key = (connect, region, tuple(sorted(kwargs.items())))
+        with self.condition:
+            while not self.idle.get(key) and self.sizes.get(key, 0) >= self.max_size:
+                self.condition.wait()
+            if self.idle.get(key):
+                return self.idle[key].pop()
+            self.sizes[key] = self.sizes.get(key, 0) + 1
+        try:
+            if isinstance(connect, string_types):
+                module_name, attribute = connect.split(':', 1)
+                connect = getattr(importlib.import_module(module_name), attribute)
+            return connect(region, **kwargs)
+        except Exception:
+            with self.condition:
+                self.sizes[key] -= 1
+                self.condition.notify()
+            raise
+
+    def put(self, conn, connect, region, **kwargs):
+        key = (connect, region, tuple(sorted(kwargs.items())))
+        with self.condition:
+            self.idle.setdefault(key, []).append(conn)
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, connect, region, **kwargs):
+        conn = self.get(connect, region, **kwargs)
+        try:
+            yield conn
+        finally:
+            self.put(conn, connect, region, **kwargs)
+
+
+# shared by everything that does not bring its own
+default_pool = ConnectionPool()
 
 
 def get_options(config_options, local_options, cli_options):
@@ -182,17 +544,17 @@ def get_options(config_options, local_options, cli_options):
     return options
 
 
-def output_log_results(formatter, context, value):
+def output_log_results(formatter, context, value, write=None):
     metric_name = (formatter % context).replace('/', '.').replace(' ', '_').lower()
     line = '{0} {1} {2}\n'.format(
         metric_name,
         value,
         context['timestamp'],
     )
-    sys.stdout.write(line)
+    (write or sys.stdout.write)(line)
 
 
-def process_log_results(results, options):
+def process_log_results(results, options, write=None):
     """
     Output CW enhanced Monitoring to stdout.
 
@@ -209,40 +571,99 @@ def process_log_results(results, options):
         context['dimension'] = message['instanceID']
         context['Namespace'] = 'AWS/RDS'
         # iterate over category keys example: ["cpuUtilization", "memory"]
-        for category, statistics in message.iteritems():
+        for category, statistics in message.items():
             context['MetricName'] = category
             statistics_type = type(statistics)
 
             # process metrics in dictionary format
             if statistics_type is dict:
-                _process_stat_dict(options['Formatter'], statistics, context, category)
+                _process_stat_dict(options['Formatter'], statistics, context, category, write)
 
             # process list values differently, because of sub types
             elif statistics_type is list:
-                for statistic_dict in statistics:
-                    statistic_list = statistic_dict.keys()
-                    # determine sub type using static map
-                    context['ListCategory'] = statistic_dict[LIST_CATEGORY_MAP.get(category)]
-                    _process_stat_dict(options['ListFormatter'], statistic_dict, context, category)
+                # determine sub type using static map
+                list_key = LIST_CATEGORY_MAP.get(category)
+                controls = options.get('Lists', {}).get(category)
+                for statistic_dict in select_list_entries(statistics, list_key, controls):
+                    context['ListCategory'] = statistic_dict[list_key]
+                    _process_stat_dict(options['ListFormatter'], statistic_dict, context, category,
+                                       write)
+
+
+def check_list_controls(lists):
+    """Check the Lists of an EnhancedMonitoring config, raising ValueError if they won't work."""
+    for category, controls in (lists or {}).items():
+        if category not in LIST_CATEGORY_MAP:
+            raise ValueError('EnhancedMonitoring Lists: {0} is not one of {1}'.format(
+                category, ', '.join(sorted(LIST_CATEGORY_MAP))))
+        top = controls.get('Top')
+        if top is not None and (type(top) is not int or top < 0):
+            raise ValueError(
+                'EnhancedMonitoring Lists: Top for {0} must be a whole number'.format(category))
+        if top is not None and not controls.get('By'):
+            raise ValueError('EnhancedMonitoring Lists: Top for {0} needs a By statistic to rank by'
+                             .format(category))
+
+
+def select_list_entries(entries, list_key, controls=None):
+    """
+    Pick the entries of an Enhanced Monitoring list category to output.
+
+    `controls` comes from the category's entry in the Lists of the
+    EnhancedMonitoring config: Allow and Deny are shell-style patterns
+    matched against each entry's `list_key`, Top keeps that many entries
+    with the highest By statistic, and with Other the statistics of the rest
+    are summed into one more entry whose `list_key` is OtherName. They should
+    have been checked with check_list_controls() when the config was loaded.
+    """
+    if not controls:
+        return entries
+    allow = controls.get('Allow')
+    if allow is not None and not isinstance(allow, list):
+        allow = [allow]
+    deny = controls.get('Deny') or []
+    if not isinstance(deny, list):
+        deny = [deny]
+
+    def matches(entry, patterns):
+        return any(fnmatchcase(text_type(entry[list_key]), pattern) for pattern in patterns)
 
+    if allow is not None or deny:
+        entries = [entry for entry in entries
+                   if (allow is None or matches(entry, allow)) and not matches(entry, deny)]
+    if controls.get('Top') is None:
+        return entries
+    by = controls['By']
 
-def _process_stat_dict(formatter, statistic_dict, context, category):
-    for statistic, value in statistic_dict.iteritems():
+    def rank(entry):
+        value = entry.get(by)
+        return value if type(value) is int or type(value) is float else float('-inf')
+
+    ranked = sorted(entries, key=rank, reverse=True)
+    selected, rest = ranked[:controls['Top']], ranked[controls['Top']:]
+    if rest and controls.get('Other'):
+        other = {list_key: controls.get('OtherName', 'other')}
+        for entry in rest:
+            for statistic, value in entry.items():
+                is_number = type(value) is int or type(value) is float
+                if statistic not in LIST_IDENTIFIERS and is_number:
+                    other[statistic] = other.get(statistic, 0) + value
+        selected.append(other)
+    return selected
+
+
+def _process_stat_dict(formatter, statistic_dict, context, category, write=None):
+    for statistic, value in statistic_dict.items():
         context['statistic'] = statistic
         # Let's not calculate same thing twice
         value_type = type(value)
         if value_type is int or value_type is float:
             context['Unit'] = UNIT_MAP[category].get(statistic, 'Count')
-            output_log_results(formatter, context, value)
-
+            output_log_results(formatter, context, value, write)
 
-def output_results(results, metric, options):
-    """
-    Output the results to stdout.
 
-    TODO: add AMPQ support for efficiency
-    """
-    formatter = options['Formatter']
+def get_context(metric):
+    """Get the values available to a Formatter for `metric`."""
     context = metric.copy()  # XXX might need to sanitize this
     try:
         context['dimension'] = list(metric['Dimensions'].values())[0]
@@ -251,6 +672,276 @@ def output_results(results, metric, options):
         context.update(metric['Dimensions'])
     except AttributeError:
         context['dimension'] = ''
+    return context
+
+
+def derived_functions(numpy, timestamps):
+    """The functions available in Derived expressions, over columns aligned to `timestamps`."""
+
+    def rate(x):
+        """Change per second since the previous datapoint."""
+        result = numpy.full(len(x), numpy.nan)
+        result[1:] = numpy.diff(x) / numpy.diff(timestamps)
+        return result
+
+    def moving_average(x, n):
+        """Mean of the last `n` datapoints, skipping gaps."""
+        valid = ~numpy.isnan(x)
+        sums = numpy.concatenate([[0], numpy.cumsum(numpy.where(valid, x, 0))])
+        counts = numpy.concatenate([[0], numpy.cumsum(valid)])
+        end = numpy.arange(1, len(x) + 1)
+        start = numpy.maximum(end - int(n), 0)
+        return (sums[end] - sums[start]) / (counts[end] - counts[start])
+
+    return {
+        'abs': numpy.abs,
+        'sqrt': numpy.sqrt,
+        'log': numpy.log,
+        'min': numpy.minimum,
+        'max': numpy.maximum,
+        'rate': rate,
+        'moving_average': moving_average,
+    }
+
+
+def compile_expression(expression, names):
+    """
+    Parse a Derived `expression` over the series in `names`, raising
+    ValueError for anything but numbers, series names, arithmetic and calls
+    to derived_functions(). Nothing in it is ever passed to eval().
+    """
+    tree = ast.parse(expression, mode='eval')
+    functions = DERIVED_FUNCTIONS
+    called = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load)):
+            continue
+        if type(node) in DERIVED_OPERATORS:
+            continue
+        if isinstance(node, ast.Call):
+            is_call = isinstance(node.func, ast.Name) and node.func.id in functions
+            if (not is_call or node.keywords or
+                    getattr(node, 'starargs', None) or getattr(node, 'kwargs', None)):
+                raise ValueError('{0}: can only call {1}'.format(
+                    expression, ', '.join(sorted(functions))))
+            if len(node.args) != functions[node.func.id]:
+                raise ValueError('{0}: {1}() takes {2} argument(s)'.format(
+                    expression, node.func.id, functions[node.func.id]))
+            if node.func.id == 'moving_average':
+                window = number_value(node.args[1])
+                if window is None or window < 1 or window != int(window):
+                    raise ValueError('{0}: the window of moving_average() must be a whole number'
+                                     .format(expression))
+            called.add(node.func)
+            continue
+        if isinstance(node, ast.Name):
+            if node.id not in names and node not in called:
+                raise ValueError('{0}: unknown series {1}'.format(expression, node.id))
+            continue
+        if number_value(node) is not None:
+            continue
+        raise ValueError('{0}: {1} is not allowed'.format(expression, type(node).__name__))
+    return tree
+
+
+def number_value(node):
+    """The value of `node` if it is a number in a parsed expression, otherwise None."""
+    value = getattr(node, 'value', getattr(node, 'n', None))
+    is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if type(node).__name__ in ('Num', 'Constant') and is_number:
+        return value
+    return None
+
+
+def evaluate_expression(tree, series, fill=None):
+    """
+    Evaluate a compiled Derived expression over `series`, a dict of series
+    name to {timestamp: value}. The series are lined up by timestamp; gaps
+    are `fill`, or else leave a gap in the result.
+
+    Returns (timestamp, value) tuples, skipping gaps and non-finite values.
+    """
+    import numpy
+
+    timestamps = sorted(set(timestamp for values in series.values() for timestamp in values))
+    if not timestamps:
+        return []
+    missing = numpy.nan if fill is None else fill
+    columns = dict((name, numpy.array([values.get(timestamp, missing) for timestamp in timestamps],
+                                      dtype=float))
+                   for name, values in series.items())
+    functions = derived_functions(numpy, numpy.array(timestamps, dtype=float))
+
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.BinOp):
+            return DERIVED_OPERATORS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp):
+            return DERIVED_OPERATORS[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.Call):
+            return functions[node.func.id](*[evaluate(arg) for arg in node.args])
+        if isinstance(node, ast.Name):
+            return columns[node.id]
+        return getattr(node, 'value', getattr(node, 'n', None))
+
+    with numpy.errstate(all='ignore'):
+        values = numpy.broadcast_to(numpy.asarray(evaluate(tree), dtype=float), (len(timestamps),))
+    return [(timestamp, float(value)) for timestamp, value in zip(timestamps, values)
+            if numpy.isfinite(value)]
+
+
+class Aggregator(object):
+    """
+    Rolls up series across a group of metrics, for the Rollups in a config,
+    and computes the Derived metrics.
+
+    Each rollup matches metrics by Namespace and optionally MetricName, and
+    groups them by the GroupBy keys, which are looked up like Formatter
+    values: in the Dimensions or anywhere in the metric's config entry. For
+    every timestamp, each of the Functions is applied to the members'
+    Statistic. With DropMembers, the members are not output themselves.
+
+    Derived metrics are grouped the same way. Each of their Series picks a
+    Statistic of a MetricName, summed if several metrics in a group match,
+    and the Expression is evaluated over the Series lined up by timestamp,
+    with numpy.
+    """
+
+    def __init__(self, rollups, derived=None):
+        self.rollups = rollups
+        self.derived = derived or []
+        self.expressions = [compile_expression(entry['Expression'], entry['Series'])
+                            for entry in self.derived]
+        if self.derived:
+            try:
+                import numpy  # noqa
+            except ImportError:
+                raise ImportError(
+                    'Derived metrics need numpy: pip install cloudwatch-to-graphite[derived]')
+        self.reset()
+
+    def reset(self):
+        # (rollup index, group) -> (context, {timestamp: [values]})
+        self.groups = OrderedDict()
+        # (derived index, group) -> (context, {series name: {timestamp: value}})
+        self.derived_groups = OrderedDict()
+
+    def matches(self, rollup, metric):
+        metric_names = rollup.get('MetricName')
+        if metric_names is not None and not isinstance(metric_names, list):
+            metric_names = [metric_names]
+        return (rollup['Namespace'] == metric['Namespace'] and
+                (metric_names is None or metric['MetricName'] in metric_names))
+
+    def rollup_group_by(self, rollup):
+        """What a rollup's groups go by: each metric on its own, by the GroupBy keys."""
+        return ['MetricName'] + rollup.get('GroupBy', [])
+
+    def group_by(self, metric):
+        """The keys every rollup and derived metric that `metric` is a member of groups it by."""
+        group_bys = [self.rollup_group_by(rollup) for rollup in self.rollups
+                     if self.matches(rollup, metric)]
+        for entry in self.derived:
+            if any(self.matches(dict(series, Namespace=series.get('Namespace', entry['Namespace'])),
+                                metric)
+                   for series in entry['Series'].values()):
+                group_bys.append(entry.get('GroupBy', []))
+        return group_bys
+
+    def observe(self, results, metric):
+        """
+        Add `results` for `metric` to any groups it belongs to.
+
+        Returns whether the results should be dropped instead of output.
+        """
+        drop = False
+        context = None
+        for index, rollup in enumerate(self.rollups):
+            if not self.matches(rollup, metric):
+                continue
+            if context is None:
+                context = get_context(metric)
+            group_by = rollup.get('GroupBy', [])
+            group = tuple(text_type(context.get(key)) for key in self.rollup_group_by(rollup))
+            statistic = rollup['Statistic']
+            if (index, group) not in self.groups:
+                group_context = dict((key, context.get(key)) for key in group_by)
+                group_context.update({
+                    'Namespace': metric['Namespace'],
+                    'MetricName': metric['MetricName'],
+                    'statistic': statistic,
+                    'group': '.'.join(group[1:]) or 'all',
+                })
+                self.groups[(index, group)] = (group_context, {})
+            group_context, values = self.groups[(index, group)]
+            for result in results:
+                if statistic in result:
+                    group_context['Unit'] = result['Unit']
+                    timestamp = timegm(result['Timestamp'].timetuple())
+                    values.setdefault(timestamp, []).append(result[statistic])
+            drop = drop or rollup.get('DropMembers', False)
+
+        for index, entry in enumerate(self.derived):
+            for name, series in sorted(entry['Series'].items()):
+                series = dict(series, Namespace=series.get('Namespace', entry['Namespace']))
+                if not self.matches(series, metric):
+                    continue
+                if context is None:
+                    context = get_context(metric)
+                group_by = entry.get('GroupBy', [])
+                group = tuple(text_type(context.get(key)) for key in group_by)
+                if (index, group) not in self.derived_groups:
+                    group_context = dict((key, context.get(key)) for key in group_by)
+                    group_context.update({
+                        'Namespace': entry['Namespace'],
+                        'Name': entry['Name'],
+                        'group': '.'.join(group) or 'all',
+                    })
+                    self.derived_groups[(index, group)] = (
+                        group_context, dict((key, {}) for key in entry['Series']))
+                values = self.derived_groups[(index, group)][1][name]
+                statistic = series['Statistic']
+                for result in results:
+                    if statistic in result:
+                        timestamp = timegm(result['Timestamp'].timetuple())
+                        values[timestamp] = values.get(timestamp, 0) + result[statistic]
+                drop = drop or entry.get('DropMembers', False)
+        return drop
+
+    def output(self, write=None):
+        """Output the rolled up series, like output_results()."""
+        for (index, group), (context, values) in self.groups.items():
+            rollup = self.rollups[index]
+            formatter = rollup.get('Formatter', DEFAULT_ROLLUP_FORMATTER)
+            for timestamp in sorted(values):
+                for function in rollup.get('Functions', ['sum']):
+                    context['function'] = function
+                    metric_name = (formatter % context).replace('/', '.').lower()
+                    line = '{0} {1} {2}\n'.format(
+                        metric_name,
+                        ROLLUP_FUNCTIONS[function](values[timestamp]),
+                        timestamp,
+                    )
+                    (write or sys.stdout.write)(line)
+
+        for (index, group), (context, series) in self.derived_groups.items():
+            entry = self.derived[index]
+            formatter = entry.get('Formatter', DEFAULT_DERIVED_FORMATTER)
+            metric_name = (formatter % context).replace('/', '.').lower()
+            for timestamp, value in evaluate_expression(self.expressions[index], series,
+                                                        entry.get('Fill')):
+                (write or sys.stdout.write)('{0} {1} {2}\n'.format(metric_name, value, timestamp))
+
+
+def output_results(results, metric, options, write=None):
+    """
+    Output the results to stdout, or pass each line to `write` instead.
+
+    TODO: add AMPQ support for efficiency
+    """
+    formatter = options['Formatter']
+    context = get_context(metric)
     for result in results:
         stat_keys = metric['Statistics']
         if not isinstance(stat_keys, list):
@@ -266,7 +957,7 @@ def output_results(results, metric, options):
                 result[statistic],
                 timegm(result['Timestamp'].timetuple()),
             )
-            sys.stdout.write(line)
+            (write or sys.stdout.write)(line)
 
 
 def value_pad_results(results, start_time, end_time, interval, value=0):
@@ -296,37 +987,14 @@ def value_pad_results(results, start_time, end_time, interval, value=0):
     return results
 
 
-def leadbutt(config_file, cli_options, verbose=False, **kwargs):
-
-    # This two functions are defined in here so that the decorator can take CLI options, passed in from main()
-    # we'll re-use the interval to sleep at the bottom of the loop that calls get_metric_statistics.
-    @retry(wait_exponential_multiplier=kwargs.get('interval', None),
-           wait_exponential_max=kwargs.get('max_interval', None),
-           # give up at the point the next cron of this script probably runs; Period is minutes; some_max_delay needs ms
-           stop_max_delay=cli_options['Count'] * cli_options['Period'] * 60 * 1000)
-    def get_metric_statistics(**kwargs):
-        """
-        A thin wrapper around boto.cloudwatch.connection.get_metric_statistics, for the
-        purpose of adding the @retry decorator
-        :param kwargs:
-        :return:
-        """
-        connection = kwargs.pop('connection')
-        return connection.get_metric_statistics(**kwargs)
-
-    @retry(wait_exponential_multiplier=kwargs.get('interval', None),
-           wait_exponential_max=kwargs.get('max_interval', None),
-           stop_max_delay=cli_options['Count'] * cli_options['Period'] * 60 * 1000)
-    def get_logs_statistics(**kwargs):
-        """
-        A thin wrapper around boto.logs.get_log_events, for the
-        purpose of adding the @retry decorator
-        :param kwargs:
-        :return:
-        """
-        connection = kwargs.pop('connection')
-        return connection.get_log_events(**kwargs)
+def plan(config_file, cli_options, **kwargs):
+    """
+    Estimate what a run of `config_file` will cost without calling AWS.
 
+    Returns a dict with the API call and datapoint counts per (namespace,
+    region), the estimated duration of a run in seconds given the request
+    interval and rate limits, and whether that fits within the period.
+    """
     config = get_config(config_file)
     config_options = config.get('Options')
     auth_options = config.get('Auth', {})
@@ -334,65 +1002,1525 @@ def leadbutt(config_file, cli_options, verbose=False, **kwargs):
     metrics = config.get('Metrics', False)
 
     region = auth_options.get('region', DEFAULT_REGION)
-    connect_args = {
-        'debug': 2 if verbose else 0,
-    }
-    if 'aws_access_key_id' in auth_options:
-        connect_args['aws_access_key_id'] = auth_options['aws_access_key_id']
-    if 'aws_secret_access_key' in auth_options:
-        connect_args['aws_secret_access_key'] = auth_options['aws_secret_access_key']
-    conn = boto.ec2.cloudwatch.connect_to_region(region, **connect_args)
+    interval = kwargs.get('interval', 0) / 1000.0
+    max_interval = kwargs.get('max_interval', 0) / 1000.0
+    base_options = get_options(config_options, None, cli_options)
+
+    namespaces = {}
+    calls = {}
+    duration = 0.0
     if metrics:
         for metric in metrics:
-            options = get_options(
-                config_options, metric.get('Options'), cli_options)
-            period_local = options['Period'] * 60
-            count_local = options['Count']
-            # if you have metrics that are available only every 5 minutes, be sure to request only stats
-            # that are likely/sure to be up to date, ie ones ending on the previous
-            # period increment.
-            end_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=int(time.time()) % period_local)
-            start_time = end_time - datetime.timedelta(seconds=period_local * count_local)
-
-            # if 'Unit 'is in the config, request only that; else get all units
-            unit = metric.get('Unit')
+            options = get_options(config_options, metric.get('Options'), cli_options)
             metric_names = metric['MetricName']
             if not isinstance(metric_names, list):
                 metric_names = [metric_names]
-            for metric_name in metric_names:
-                # we need a copy of the metric dict with the MetricName swapped out
-                this_metric = metric.copy()
-                this_metric['MetricName'] = metric_name
-                results = get_metric_statistics(
-                    connection=conn,
-                    period=period_local,
-                    start_time=start_time,
-                    end_time=end_time,
-                    metric_name=metric_name,
-                    namespace=metric['Namespace'],
-                    statistics=metric['Statistics'],
-                    dimensions=metric['Dimensions'],
-                    unit=unit
-                )
+            statistics = metric['Statistics']
+            if not isinstance(statistics, list):
+                statistics = [statistics]
+            summary = namespaces.setdefault((metric['Namespace'], region),
+                                            {'calls': 0, 'datapoints': 0})
+            summary['calls'] += len(metric_names)
+            summary['datapoints'] += len(metric_names) * len(statistics) * options['Count']
+            calls['GetMetricStatistics'] = calls.get('GetMetricStatistics', 0) + len(metric_names)
+            duration += len(metric_names) * (PLAN_REQUEST_LATENCY + interval)
 
-                if 'NullIsZero' in options and metric_name in options['NullIsZero']:
-                    results = value_pad_results(
-                        results,
-                        start_time,
-                        end_time,
-                        options['NullIsZero'][metric_name],
-                    )
+    log_stream_duration = 0.0
+    if enhanced_monitoring:
+        # the number of log streams is only known at run time, so the cost of
+        # each stream is reported separately from the totals
+        namespaces[('AWS/RDS EnhancedMonitoring', region)] = {'calls': 1, 'datapoints': 0}
+        calls['DescribeLogStreams'] = calls.get('DescribeLogStreams', 0) + 1
+        duration += PLAN_REQUEST_LATENCY
+        log_stream_duration = PLAN_REQUEST_LATENCY + PLAN_LOG_STREAM_SLEEP
 
-                output_results(results, this_metric, options)
-                time.sleep(kwargs.get('interval', 0) / 1000.0)
+    # no matter how short the sleeps are, the rate limits set a lower bound
+    throttled = sum(float(count) / PLAN_RATE_LIMITS[action] for action, count in calls.items())
+    duration = max(duration, throttled)
+    # if every request gets throttled once, it backs off for up to max_interval
+    worst_duration = duration + sum(calls.values()) * max_interval
+    period = base_options['Period'] * 60
+    cost = sum(count * PLAN_REQUEST_COST[action] / 1000 for action, count in calls.items())
+    return {
+        'namespaces': namespaces,
+        'calls': calls,
+        'datapoints': sum(x['datapoints'] for x in namespaces.values()),
+        'duration': duration,
+        'worst_duration': worst_duration,
+        'log_stream_duration': log_stream_duration,
+        'period': period,
+        'cost': cost,
+        'monthly_cost': cost * 30 * 24 * 60 * 60 / period,
+        'fits': duration <= period,
+    }
 
-    # get enhanced monitoring if it is enabled
-    if enhanced_monitoring:
-        options = get_options(config_options, None, cli_options)
-        # convert minutes to seconds
+
+def output_plan(report):
+    """Output a report from plan() to stdout."""
+    for (namespace, region), summary in sorted(report['namespaces'].items()):
+        sys.stdout.write('{0} {1}: {2} API calls, {3} datapoints\n'.format(
+            namespace, region, summary['calls'], summary['datapoints']))
+    sys.stdout.write('Total: {0} API calls, {1} datapoints per run\n'.format(
+        sum(report['calls'].values()), report['datapoints']))
+    sys.stdout.write('Estimated duration: {0:.1f}s of a {1}s period\n'.format(
+        report['duration'], report['period']))
+    sys.stdout.write('Worst case with one backoff per call: {0:.1f}s\n'.format(
+        report['worst_duration']))
+    if report['log_stream_duration']:
+        sys.stdout.write(
+            '  plus {0:.1f}s and 1 GetLogEvents call per Enhanced Monitoring log stream\n'.format(
+                report['log_stream_duration']))
+    sys.stdout.write('Estimated cost: ${0:.4f} per run, ${1:.2f} per month\n'.format(
+        report['cost'], report['monthly_cost']))
+    if not report['fits']:
+        sys.stdout.write('WARNING: this config can not finish within its period\n')
+
+
+def write_stdout(lines):
+    """Write `lines` to stdout, flushing so a broken pipe shows up right away."""
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
+
+
+class Spool(object):
+    """
+    An append-only queue of output lines on disk, for when the sink is down.
+
+    Lines are appended in batches to numbered segment files in `directory`.
+    Segments are read back with mmap, oldest first, and deleted once drained;
+    how far into the oldest segment has been drained is kept in an offset
+    file, so a spool picks up where it left off after a restart. The oldest
+    segments get dropped to keep the spool under `max_bytes`, and segments
+    last written to more than `max_age` seconds ago are dropped too.
+    """
+    suffix = '.seg'
+
+    def __init__(self, directory, max_bytes=SPOOL_MAX_BYTES, max_age=SPOOL_MAX_AGE,
+                 segment_bytes=SPOOL_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.offset_file = os.path.join(directory, 'drain.offset')
+        self.lock = threading.Lock()
+        self.fp = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self.segments()
+        self.next_segment = int(segments[-1][:-len(self.suffix)]) + 1 if segments else 1
+
+    def segments(self):
+        return sorted(x for x in os.listdir(self.directory) if x.endswith(self.suffix))
+
+    def pending(self):
+        """Are there lines waiting to be drained?"""
+        return bool(self.segments())
+
+    def append(self, lines):
+        """Append a batch of lines; each must end with a newline."""
+        data = ''.join(lines).encode('utf-8')
+        with self.lock:
+            if self.fp is None or self.fp.tell() >= self.segment_bytes:
+                self.roll()
+            self.fp.write(data)
+            self.fp.flush()
+
+    def roll(self):
+        """Start a new segment, and enforce the size and age limits."""
+        if self.fp is not None:
+            self.fp.close()
+        path = os.path.join(self.directory, '{0:020d}{1}'.format(self.next_segment, self.suffix))
+        self.next_segment += 1
+        self.fp = open(path, 'ab')
+        self.trim()
+
+    def trim(self):
+        paths = [(x, os.path.join(self.directory, x)) for x in self.segments()]
+        sizes = [(x, os.path.getsize(path), os.path.getmtime(path)) for x, path in paths]
+        total = sum(size for name, size, mtime in sizes)
+        oldest_allowed = time.time() - self.max_age
+        # never drop the segment being written to
+        for name, size, mtime in sizes[:-1]:
+            if total <= self.max_bytes and mtime >= oldest_allowed:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            if self.load_offset()[0] == name:
+                self.save_offset(None, 0)
+
+    def load_offset(self):
+        try:
+            with open(self.offset_file) as fp:
+                name, offset = fp.read().split()
+            return name, int(offset)
+        except (IOError, OSError, ValueError):
+            return None, 0
+
+    def save_offset(self, name, offset):
+        with open(self.offset_file, 'w') as fp:
+            fp.write('{0} {1}\n'.format(name, offset))
+
+    def drain(self, write, max_lines=None, batch_size=SPOOL_DRAIN_BATCH):
+        """
+        Pass the spooled lines to `write`, oldest first, in batches of up to
+        `batch_size` lines, stopping after `max_lines` if it is set.
+
+        Returns how many lines were drained. If `write` raises, the lines it
+        was given stay in the spool.
+        """
+        import mmap
+
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+        drained = 0
+        for name in self.segments():
+            if max_lines is not None and drained >= max_lines:
+                break
+            path = os.path.join(self.directory, name)
+            saved_name, offset = self.load_offset()
+            if saved_name != name:
+                offset = 0
+            size = os.path.getsize(path)
+            if size > offset:
+                with open(path, 'rb') as fp:
+                    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        while offset < size:
+                            if max_lines is not None and drained >= max_lines:
+                                return drained
+                            end = offset
+                            batch = batch_size
+                            if max_lines is not None:
+                                batch = min(batch_size, max_lines - drained)
+                            for x in range(batch):
+                                newline = data.find(b'\n', end, size)
+                                end = size if newline == -1 else newline + 1
+                                if end == size:
+                                    break
+                            lines = data[offset:end].decode('utf-8').splitlines(True)
+                            write(lines)
+                            drained += len(lines)
+                            offset = end
+                            self.save_offset(name, offset)
+                    finally:
+                        data.close()
+            os.remove(path)
+            self.save_offset(None, 0)
+        return drained
+
+
+class SpoolingOutput(object):
+    """
+    Collects output lines into batches and writes them with `sink`, a
+    function that takes a list of lines.
+
+    Once the sink fails, batches go to `spool` instead. Every
+    `retry_interval` seconds the sink is tried again by draining the spool
+    into it; new batches only go straight to the sink once the spool is
+    empty, so lines stay in order.
+
+    Each flush only drains as many lines as `drain_rate` allows for the time
+    since the last one, up to a second's worth, so a big spool doesn't hold
+    up whatever is calling flush().
+    """
+
+    def __init__(self, sink, spool, drain_rate=SPOOL_DRAIN_RATE,
+                 retry_interval=SPOOL_RETRY_INTERVAL):
+        self.sink = sink
+        self.spool = spool
+        self.drain_rate = drain_rate
+        self.retry_interval = retry_interval
+        self.lines = []
+        self.retry_at = 0
+        self.drain_credit = 0
+        self.drained_at = None
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def drain_budget(self):
+        """How many spooled lines this flush can send, or None for no limit."""
+        if not self.drain_rate:
+            return None
+        now = time.time()
+        elapsed = 1 if self.drained_at is None else now - self.drained_at
+        self.drained_at = now
+        self.drain_credit = min(self.drain_credit + elapsed * self.drain_rate, self.drain_rate)
+        return int(self.drain_credit)
+
+    def flush(self):
+        lines, self.lines = self.lines, []
+        if time.time() >= self.retry_at and self.spool.pending():
+            budget = self.drain_budget()
+            try:
+                if budget != 0:
+                    drained = self.spool.drain(self.sink, max_lines=budget)
+                    if budget is not None:
+                        self.drain_credit -= drained
+            except (IOError, OSError):
+                self.drain_credit = 0
+                self.retry_at = time.time() + self.retry_interval
+        if not lines:
+            return
+        if time.time() >= self.retry_at and not self.spool.pending():
+            try:
+                self.sink(lines)
+                return
+            except (IOError, OSError):
+                self.retry_at = time.time() + self.retry_interval
+        self.spool.append(lines)
+
+
+class Sink(object):
+    """
+    Somewhere to send output lines. Lines come in Graphite plaintext format,
+    'name value timestamp\\n'; sinks for other formats convert them.
+    """
+    name = 'sink'
+
+    def format(self, line):
+        return line
+
+    def send(self, lines):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StdoutSink(Sink):
+    name = 'stdout'
+
+    def send(self, lines):
+        write_stdout([self.format(line) for line in lines])
+
+
+class FileSink(Sink):
+    def __init__(self, path):
+        self.name = path
+        self.fp = open(path, 'a')
+
+    def send(self, lines):
+        self.fp.write(''.join(self.format(line) for line in lines))
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class GraphiteSink(Sink):
+    """Graphite plaintext protocol over TCP, reconnecting after errors."""
+
+    def __init__(self, host, port=2003, timeout=SINK_TIMEOUT):
+        self.name = '{0}:{1}'.format(host, port)
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+
+    def send(self, lines):
+        data = ''.join(self.format(line) for line in lines).encode('utf-8')
+        try:
+            if self.sock is None:
+                import socket
+                self.sock = socket.create_connection(self.address, self.timeout)
+            self.sock.sendall(data)
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class StatsdSink(Sink):
+    """StatsD gauges over UDP. StatsD has no timestamps, so they get dropped."""
+    max_packet = 512
+
+    def __init__(self, host, port=8125):
+        self.name = '{0}:{1}'.format(host, port)
+        import socket
+
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, line):
+        name, value, timestamp = line.split()
+        return '{0}:{1}|g\n'.format(name, value)
+
+    def send(self, lines):
+        packet = ''
+        for line in lines:
+            line = self.format(line)
+            if packet and len(packet) + len(line) > self.max_packet:
+                self.sock.sendto(packet.encode('utf-8'), self.address)
+                packet = ''
+            packet += line
+        if packet:
+            self.sock.sendto(packet.encode('utf-8'), self.address)
+
+    def close(self):
+        self.sock.close()
+
+
+class InfluxDBSink(Sink):
+    """InfluxDB line protocol over HTTP, with the metric name as the measurement."""
+
+    def __init__(self, url, timeout=SINK_TIMEOUT):
+        self.name = url
+        self.url = url
+        self.timeout = timeout
+
+    def format(self, line):
+        name, value, timestamp = line.split()
+        measurement = name.replace(',', '\\,').replace(' ', '\\ ')
+        return '{0} value={1} {2}\n'.format(measurement, value, timestamp)
+
+    def send(self, lines):
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:
+            from urllib2 import Request, urlopen
+
+        data = ''.join(self.format(line) for line in lines).encode('utf-8')
+        urlopen(Request(self.url, data=data), timeout=self.timeout).read()
+
+
+class SeriesStore(object):
+    """
+    The latest datapoint of each series, by metric name.
+
+    Names are interned and map to an index into two arrays of values and
+    timestamps, so each series costs a dict entry and 16 bytes, and
+    hundreds of thousands of them fit in not much memory.
+    """
+
+    def __init__(self):
+        from array import array
+
+        self.index = {}
+        self.values = array(str('d'))
+        self.timestamps = array(str('d'))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def update(self, name, value, timestamp):
+        """Keep `value` for `name` unless there is a later one already."""
+        with self.lock:
+            i = self.index.get(name)
+            if i is None:
+                self.index[intern(str(name))] = len(self.values)
+                self.values.append(value)
+                self.timestamps.append(timestamp)
+            elif timestamp >= self.timestamps[i]:
+                self.values[i] = value
+                self.timestamps[i] = timestamp
+
+    def items(self):
+        """A snapshot of (name, value, timestamp) for every series."""
+        with self.lock:
+            return [(name, self.values[i], self.timestamps[i]) for name, i in self.index.items()]
+
+
+def prometheus_name(name):
+    """Turn a Graphite metric name into a Prometheus one."""
+    name = re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+    return '_' + name if name[0].isdigit() else name
+
+
+class SeriesStoreHandler:
+    """
+    Serves the SeriesStore of its server as Prometheus text or JSON. ServeSink
+    mixes it into a BaseHTTPRequestHandler.
+
+    It is an old-style class on Python 2 on purpose: BaseHTTPRequestHandler
+    is one there, and with a new-style mixin in front, constructing the
+    handler ends up in object.__init__, which takes no arguments.
+    """
+
+    def do_GET(self):
+        items = sorted(self.server.store.items())
+        if self.path == '/metrics':
+            content_type = 'text/plain; version=0.0.4'
+            body = ''.join(
+                '{0} {1!r} {2}\n'.format(prometheus_name(name), value, int(timestamp) * 1000)
+                for name, value, timestamp in items)
+        elif self.path == '/metrics.json':
+            content_type = 'application/json'
+            body = json.dumps(OrderedDict((name, [value, int(timestamp)])
+                                          for name, value, timestamp in items))
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # stderr is for leadbutt's own messages
+
+
+class ServeSink(Sink):
+    """
+    Keeps the latest value of each series in a SeriesStore and serves it over
+    HTTP, for scrapers that only want current values. It only lives as long
+    as the process, so it is mostly useful with --daemon.
+    """
+
+    def __init__(self, host, port):
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        class Handler(SeriesStoreHandler, BaseHTTPRequestHandler):
+            pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.name = '{0}:{1}'.format(host, port)
+        self.store = SeriesStore()
+        self.server = Server((host, port), Handler)
+        self.server.store = self.store
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, lines):
+        for line in lines:
+            name, value, timestamp = line.split()
+            self.store.update(name, float(value), float(timestamp))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get_sink(url):
+    """
+    Make a Sink from a URL like `graphite://host:2003`, `statsd://host:8125`,
+    `influxdb://host:8086?db=name`, `serve://host:port`, `file:///path` or
+    `stdout`.
+    """
+    try:
+        from urllib.parse import parse_qsl, urlencode, urlparse
+    except ImportError:
+        from urllib import urlencode
+        from urlparse import parse_qsl, urlparse
+
+    parsed = urlparse(url)
+    if url in ('stdout', '-'):
+        return StdoutSink()
+    if parsed.scheme == 'file':
+        return FileSink(parsed.path)
+    if parsed.scheme == 'graphite':
+        return GraphiteSink(parsed.hostname, parsed.port or 2003)
+    if parsed.scheme == 'statsd':
+        return StatsdSink(parsed.hostname, parsed.port or 8125)
+    if parsed.scheme == 'serve':
+        return ServeSink(parsed.hostname or '', parsed.port)
+    if parsed.scheme == 'influxdb':
+        query = dict((key, value) for key, value in parse_qsl(parsed.query)
+                     if key not in SINK_PARAMETERS)
+        query['precision'] = 's'
+        return InfluxDBSink('http://{0}:{1}/write?{2}'.format(
+            parsed.hostname, parsed.port or 8086, urlencode(sorted(query.items()))))
+    raise ValueError('unknown sink {0}'.format(url))
+
+
+class SinkWorker(object):
+    """
+    Sends lines to a Sink from a thread of its own, so a slow sink does not
+    hold up fetching metrics.
+
+    Lines wait in a queue of up to `queue_size` lines. When it is full, the
+    'block' policy makes write() wait for room, and the 'drop' policy drops
+    the line. The thread sends up to `batch_size` lines at a time, at least
+    every `flush_interval` seconds. If `spool` is set, batches that fail get
+    spooled (see SpoolingOutput), otherwise they are dropped.
+    """
+
+    def __init__(self, sink, batch_size=SINK_BATCH_SIZE, flush_interval=SINK_FLUSH_INTERVAL,
+                 policy='block', queue_size=SINK_QUEUE_SIZE, spool=None):
+        if policy not in ('block', 'drop'):
+            raise ValueError('unknown policy {0}'.format(policy))
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.queue = queue.Queue(queue_size)
+        self.output = SpoolingOutput(self.send_to_sink, spool) if spool is not None else None
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line):
+        if self.policy == 'block':
+            self.queue.put(line)
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Send what's left in the queue and stop."""
+        self.queue.put(None)
+        self.thread.join()
+        self.sink.close()
+
+    def run(self):
+        lines = []
+        flush_at = time.time() + self.flush_interval
+        while True:
+            try:
+                line = self.queue.get(timeout=max(flush_at - time.time(), 0))
+            except queue.Empty:
+                line = ''
+            if line:
+                lines.append(line)
+            if line is None or len(lines) >= self.batch_size or time.time() >= flush_at:
+                self.send(lines)
+                lines = []
+                flush_at = time.time() + self.flush_interval
+            if line is None:
+                return
+
+    def send_to_sink(self, lines):
+        """
+        Send `lines`, only counting them once the sink took them. If the sink
+        fails on something other than IO, like a line it can't parse, sending
+        them again won't help, so the batch gets dropped.
+        """
+        try:
+            self.sink.send(lines)
+        except (IOError, OSError):
+            self.errors += 1
+            raise
+        except Exception as e:
+            self.errors += 1
+            self.dropped += len(lines)
+            sys.stderr.write('ERROR: dropped {0} lines {1} could not send: {2!r}\n'.format(
+                len(lines), self.sink.name, e))
+            return
+        self.sent += len(lines)
+
+    def send(self, lines):
+        if self.output is not None:
+            for line in lines:
+                self.output.write(line)
+            self.output.flush()
+            return
+        if not lines:
+            return
+        try:
+            self.send_to_sink(lines)
+        except (IOError, OSError) as e:
+            self.dropped += len(lines)
+            sys.stderr.write('ERROR: could not send {0} lines to {1}: {2}\n'.format(
+                len(lines), self.sink.name, e))
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+class FanOut(object):
+    """Passes each output line on to several SinkWorkers."""
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def write(self, line):
+        for worker in self.workers:
+            worker.write(line)
+
+    def flush(self):
+        pass  # the workers flush on their own
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def stats(self):
+        return dict((worker.sink.name, worker.stats()) for worker in self.workers)
+
+
+def output_sink_stats(fan_out):
+    """Output the queue depth and counters of each sink to stderr."""
+    for name, stats in sorted(fan_out.stats().items()):
+        sys.stderr.write('{0}: {1} queued, {2} sent, {3} dropped, {4} errors\n'.format(
+            name, stats['queued'], stats['sent'], stats['dropped'], stats['errors']))
+
+
+def get_sink_worker(url, shard=None):
+    """
+    Make a SinkWorker from a sink URL; the `batch`, `flush`, `policy`,
+    `queue` and `spool` query parameters set its options. Each `shard` gets
+    a spool of its own.
+    """
+    try:
+        from urllib.parse import parse_qsl, urlparse
+    except ImportError:
+        from urlparse import parse_qsl, urlparse
+
+    params = dict(parse_qsl(urlparse(url).query))
+    spool = Spool(shard_path(params['spool'], shard)) if 'spool' in params else None
+    return SinkWorker(
+        get_sink(url),
+        batch_size=int(params.get('batch', SINK_BATCH_SIZE)),
+        flush_interval=float(params.get('flush', SINK_FLUSH_INTERVAL)),
+        policy=params.get('policy', 'block'),
+        queue_size=int(params.get('queue', SINK_QUEUE_SIZE)),
+        spool=spool,
+    )
+
+
+def write_json_atomically(path, data):
+    """Replace `path` with `data` as JSON so a reader never sees half a file."""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.rename(tmp_path, path)
+
+
+class PollSchedule(object):
+    """
+    Learns how often each series actually gets new datapoints, and skips
+    polling it until a new one is likely.
+
+    For each query key, the state file keeps the timestamp of the latest
+    datapoint, the median time between datapoints, how many polls in a row
+    came back empty, and when to poll next. Empty series back off
+    exponentially, and nothing waits longer than `max_backoff` seconds, so
+    every series gets probed again now and then.
+    """
+
+    def __init__(self, state_file, max_backoff=ADAPTIVE_MAX_BACKOFF):
+        self.state_file = state_file
+        self.max_backoff = max_backoff
+        try:
+            with open(state_file) as fp:
+                self.state = json.load(fp)
+        except (IOError, OSError, ValueError):
+            self.state = {}
+
+    def due(self, key, now=None):
+        """Should `key` be polled now?"""
+        return self.state.get(key, {}).get('next', 0) <= (now or time.time())
+
+    def since(self, key):
+        """The timestamp of the latest datapoint seen for `key`, if any."""
+        return self.state.get(key, {}).get('last')
+
+    def observe(self, key, results, period, now=None):
+        """Learn from the `results` of polling `key`, and schedule the next poll."""
+        now = now or time.time()
+        state = self.state.setdefault(key, {'empty': 0})
+        timestamps = sorted(set(timegm(result['Timestamp'].timetuple()) for result in results))
+        if not timestamps:
+            state['empty'] += 1
+            state['next'] = now + min(period * 2 ** state['empty'], self.max_backoff)
+            return
+        state['empty'] = 0
+        if state.get('last') is not None and state['last'] < timestamps[0]:
+            timestamps.insert(0, state['last'])
+        deltas = sorted(b - a for a, b in zip(timestamps, timestamps[1:]))
+        if deltas:
+            state['cadence'] = deltas[len(deltas) // 2]
+        state['last'] = max(timestamps[-1], state.get('last') or 0)
+        # don't poll again until the next datapoint is due
+        next_datapoint = state['last'] + state.get('cadence', period) + period
+        state['next'] = min(max(now + period, next_datapoint), now + self.max_backoff)
+
+    def forget(self, keys):
+        """Drop the state for `keys`, like queries that are no longer in the config."""
+        for key in keys:
+            self.state.pop(key, None)
+
+    def save(self):
+        write_json_atomically(self.state_file, self.state)
+
+
+class RevisionTracker(object):
+    """
+    Remembers the datapoints already output for each series, so that when
+    the same periods get fetched again only the ones that are new or whose
+    values changed are output again.
+
+    With `state_file`, this carries over between runs; otherwise it only
+    lasts as long as the process, which is enough for --daemon.
+    """
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.state = {}
+        if state_file is not None:
+            try:
+                with open(state_file) as fp:
+                    self.state = json.load(fp)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def revise(self, key, results, oldest):
+        """
+        Get the `results` for `key` that have not been output as they are,
+        and remember them. Datapoints from before `oldest`, a timestamp,
+        won't be fetched again, so they are forgotten.
+        """
+        seen = self.state.setdefault(key, {})
+        for timestamp in list(seen):
+            if int(timestamp) < oldest:
+                del seen[timestamp]
+        revised = []
+        for result in results:
+            timestamp = str(timegm(result['Timestamp'].timetuple()))
+            values = dict((name, value) for name, value in result.items() if name != 'Timestamp')
+            if seen.get(timestamp) != values:
+                seen[timestamp] = values
+                revised.append(result)
+        if not seen:
+            del self.state[key]
+        return revised
+
+    def forget(self, keys):
+        for key in keys:
+            self.state.pop(key, None)
+
+    def save(self):
+        if self.state_file is not None:
+            write_json_atomically(self.state_file, self.state)
+
+
+class ResponseCache(object):
+    """
+    Keeps CloudWatch responses for a while, so config files with queries in
+    common share one fetch.
+
+    Responses are keyed by everything in the query but its time window, and
+    a cached response answers any query whose window it covers, like one
+    with a smaller Count. The least recently used responses are evicted
+    past `max_entries`, and responses expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fetch(self, scope, get_metric_statistics, **kwargs):
+        """
+        Get the response to get_metric_statistics(**kwargs) from the cache,
+        or call it and cache the response. `scope` identifies the account and
+        region the query is for.
+        """
+        results = self.get(scope, **kwargs)
+        if results is None:
+            results = get_metric_statistics(**kwargs)
+            self.put(scope, results, **kwargs)
+        return results
+
+    def key(self, scope, kwargs):
+        statistics = kwargs['statistics']
+        if not isinstance(statistics, list):
+            statistics = [statistics]
+        return json.dumps([scope, kwargs['namespace'], kwargs['metric_name'], kwargs['dimensions'],
+                           sorted(statistics), kwargs.get('unit'), kwargs['period']],
+                          sort_keys=True)
+
+    def get(self, scope, **kwargs):
+        """Get the cached response to a query, or None on a miss."""
+        key = self.key(scope, kwargs)
+        start_time, end_time = kwargs['start_time'], kwargs['end_time']
+        entry = self.entries.pop(key, None)
+        if (entry is not None and entry['expires'] > time.time() and
+                entry['start_time'] <= start_time and end_time <= entry['end_time']):
+            self.hits += 1
+            self.entries[key] = entry
+            return [result for result in entry['results']
+                    if start_time <= result['Timestamp'] < end_time]
+        self.misses += 1
+        return None
+
+    def put(self, scope, results, **kwargs):
+        """Cache the `results` of a query."""
+        self.entries[self.key(scope, kwargs)] = {
+            'start_time': kwargs['start_time'],
+            'end_time': kwargs['end_time'],
+            'results': results,
+            'expires': time.time() + self.ttl,
+        }
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def output_cache_stats(cache):
+    """Output the hit and miss counters of the response cache to stderr."""
+    stats = cache.stats()
+    sys.stderr.write('response cache: {0} entries, {1} hits, {2} misses, {3} evictions\n'.format(
+        stats['entries'], stats['hits'], stats['misses'], stats['evictions']))
+
+
+def encode_time(obj):
+    """json.dumps() `default` that stores datetimes as UTC timestamps."""
+    if isinstance(obj, datetime.datetime):
+        return timegm(obj.timetuple())
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+class Capture(object):
+    """
+    Records the responses from AWS, to --replay later.
+
+    Each run goes in a segment of its own, a gzipped file with one JSON
+    record per line of the kind of request, the request and the response.
+    Segment names sort in the order they were recorded.
+    """
+    segments = itertools.count()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fp = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        """Start a new segment."""
+        import gzip
+
+        self.finish()
+        name = '{0}-{1}-{2:04d}.jsonl.gz'.format(
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(), next(self.segments))
+        self.fp = gzip.open(os.path.join(self.directory, name), 'wb')
+
+    def record(self, kind, request, response, key=None):
+        if self.fp is None:
+            self.start()
+        record = {'kind': kind, 'request': request, 'response': response}
+        if key is not None:
+            record['key'] = key
+        self.fp.write((json.dumps(record, default=encode_time) + '\n').encode('utf-8'))
+
+    def finish(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+def iter_capture(directory):
+    """Yield (segment name, record) for everything recorded in `directory`, in order."""
+    import gzip
+
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.jsonl.gz'):
+            continue
+        with gzip.open(os.path.join(directory, name), 'rb') as fp:
+            for line in fp:
+                yield name, json.loads(line.decode('utf-8'))
+
+
+class RunCoordinator(object):
+    """
+    Keeps runs of the same config from overlapping.
+
+    A run holds an exclusive lock on a lock file for as long as it runs, and
+    records which queries it has completed in a progress file next to it.
+    When a new run finds the lock taken, it either skips, or takes over: it
+    leaves a handoff file, the running run notices it between queries, saves
+    its progress and stops, and the new run carries on with only the queries
+    the old one had not completed.
+    """
+    save_interval = 1  # seconds between saving progress
+
+    def __init__(self, config_file, lock_dir=None, shard=None):
+        import hashlib
+        import tempfile
+
+        name = '{0} {1}'.format(os.path.abspath(config_file), shard)
+        name = hashlib.md5(name.encode('utf-8')).hexdigest()
+        base = os.path.join(lock_dir or tempfile.gettempdir(), 'leadbutt-{0}'.format(name))
+        self.lock_file = base + '.lock'
+        self.progress_file = base + '.progress'
+        self.handoff_file = base + '.handoff'
+        self.fp = None
+        self.completed = set()
+        self.took_over_from = None
+        self.saved_at = 0
+        self.locked_at = None
+
+    def try_lock(self):
+        import fcntl
+
+        if self.fp is None:
+            self.fp = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.locked_at = time.time()
+            return True
+        except (IOError, OSError):
+            return False
+
+    def acquire(self, takeover=False, timeout=60):
+        """
+        Take the lock, returning whether we got it. If `takeover` is set and
+        another run has it, ask that run to hand over and wait up to
+        `timeout` seconds for it to.
+        """
+        if not self.try_lock():
+            if not takeover:
+                return False
+            with open(self.handoff_file, 'w') as fp:
+                fp.write('{0}\n'.format(os.getpid()))
+            give_up_at = time.time() + timeout
+            while not self.try_lock():
+                if time.time() >= give_up_at:
+                    os.remove(self.handoff_file)
+                    return False
+                time.sleep(0.1)
+            progress = self.load()
+            if not progress.get('done'):
+                self.completed = set(progress.get('completed', []))
+                self.took_over_from = progress.get('pid')
+        # a handoff from before we got the lock was meant for the run before
+        # us, whether it handed over or finished on its own
+        if self.handoff_mtime() is not None and self.handoff_mtime() < self.locked_at:
+            try:
+                os.remove(self.handoff_file)
+            except OSError:
+                pass
+        self.save(force=True)
+        return True
+
+    def handoff_mtime(self):
+        try:
+            return os.path.getmtime(self.handoff_file)
+        except OSError:
+            return None
+
+    def next_run(self):
+        """Start over with nothing completed, for daemons."""
+        self.completed = set()
+        self.took_over_from = None
+        self.save(force=True)
+
+    def superseded(self):
+        """Has another run asked to take over since we got the lock?"""
+        mtime = self.handoff_mtime()
+        return mtime is not None and self.locked_at is not None and mtime >= self.locked_at
+
+    def complete(self, key):
+        self.completed.add(key)
+        self.save()
+
+    def load(self):
+        try:
+            with open(self.progress_file) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, force=False, done=False):
+        if not force and time.time() < self.saved_at + self.save_interval:
+            return
+        write_json_atomically(self.progress_file, {
+            'pid': os.getpid(),
+            'took_over_from': self.took_over_from,
+            'completed': sorted(self.completed),
+            'done': done,
+        })
+        self.saved_at = time.time()
+
+    def release(self, done=True):
+        """Save the progress so far and let go of the lock."""
+        import fcntl
+
+        self.save(force=True, done=done)
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        self.fp.close()
+        self.fp = None
+
+
+def query_key(metric, options):
+    """
+    Get a stable key identifying the CloudWatch query for `metric` and how
+    its output is formatted with `options`.
+
+    `metric` must have a single MetricName. The key is a string so it can be
+    hashed and stored in JSON.
+    """
+    return json.dumps([
+        metric['Namespace'], metric['MetricName'], metric.get('Dimensions'),
+        metric.get('Statistics'), metric.get('Unit'),
+        options['Period'], options['Count'], options['Formatter'],
+    ], sort_keys=True)
+
+
+def request_key(metric, options):
+    """Get a key for the GetMetricStatistics request that `metric` makes, whatever its Formatter."""
+    return json.dumps([
+        metric['Namespace'], metric['MetricName'], metric.get('Dimensions'),
+        metric.get('Statistics'), metric.get('Unit') or None, options['Period'] * 60,
+    ], sort_keys=True)
+
+
+def recorded_request_key(request):
+    """Get the request_key() of a `request` recorded by --capture."""
+    return request_key({
+        'Namespace': request['namespace'],
+        'MetricName': request['metric_name'],
+        'Dimensions': request['dimensions'],
+        'Statistics': request['statistics'],
+        'Unit': request.get('unit'),
+    }, {'Period': request['period'] // 60})
+
+
+def get_queries(config, cli_options):
+    """
+    Expand the Metrics in `config` into one query per MetricName.
+
+    Returns an OrderedDict of query_key() to (metric, options), where metric is
+    a copy of the config entry with the MetricName swapped out.
+    """
+    config_options = config.get('Options')
+    queries = OrderedDict()
+    for metric in config.get('Metrics') or []:
+        options = get_options(config_options, metric.get('Options'), cli_options)
+        metric_names = metric['MetricName']
+        if not isinstance(metric_names, list):
+            metric_names = [metric_names]
+        for metric_name in metric_names:
+            # we need a copy of the metric dict with the MetricName swapped out
+            this_metric = metric.copy()
+            this_metric['MetricName'] = metric_name
+            queries[query_key(this_metric, options)] = (this_metric, options)
+    return queries
+
+
+def parse_shard(shard):
+    """Parse an 'I/N' shard spec into a (I, N) tuple."""
+    index, count = [int(x) for x in shard.split('/', 1)]
+    if not 1 <= index <= count:
+        raise ValueError('shard {0} is not between 1 and {1}'.format(index, count))
+    return index, count
+
+
+def shard_path(path, shard):
+    """
+    Get the file or directory that shard `shard`, an (I, N) tuple, keeps its
+    state in, so shards don't overwrite each other's. Without a shard it is
+    `path` itself.
+    """
+    if shard is None:
+        return path
+    return '{0}.{1}-of-{2}'.format(path, shard[0], shard[1])
+
+
+def get_shard(key, count):
+    """
+    Pick which of `count` shards, counting from 1, `key` belongs to.
+
+    This is rendezvous hashing: every shard scores the key and the highest
+    score wins, so adding a shard only moves the keys the new shard wins,
+    about 1/count of them.
+    """
+    import hashlib
+
+    key = key.encode('utf-8')
+    scores = [hashlib.md5('{0}:'.format(index).encode('utf-8') + key).hexdigest()
+              for index in range(1, count + 1)]
+    return scores.index(max(scores)) + 1
+
+
+def shard_key(key, metric, aggregator):
+    """
+    Get the key to shard the query `key` for `metric` by.
+
+    Members of Rollups and Derived metrics go by the group they are in, so a
+    whole group ends up in one shard instead of each shard outputting part of
+    it under the same name. When the query is in several groups, it goes by
+    the broadest, which only works if that one takes in all the others; if
+    not, this raises ValueError.
+    """
+    group_bys = aggregator.group_by(metric)
+    if not group_bys:
+        return key
+    context = get_context(metric)
+    groups = [frozenset((name, text_type(context.get(name))) for name in group_by)
+              for group_by in group_bys]
+    broadest = min(groups, key=len)
+    if not all(broadest <= group for group in groups):
+        raise ValueError(
+            '{0} {1} is grouped by different GroupBy keys, so it can not be sharded'.format(
+                metric['Namespace'], metric['MetricName']))
+    return json.dumps(sorted(broadest))
+
+
+def in_shard(key, shard):
+    """Does `key` belong in `shard`, an (I, N) tuple? Everything does if `shard` is None."""
+    return shard is None or get_shard(key, shard[1]) == shard[0]
+
+
+class Runner(object):
+    """
+    Fetches the metrics in a config file from CloudWatch and outputs them.
+
+    The config is read once, so a Runner can be run again and again, keeping
+    its connections, and reload() only swaps out the queries that changed.
+    """
+
+    def __init__(self, config_file, cli_options, verbose=False, **kwargs):
+        self.config_file = config_file
+        self.cli_options = cli_options
+        self.verbose = verbose
+        self.kwargs = kwargs
+        self.queries = OrderedDict()
+        self.auth_options = None
+        self.connect_args = {}
+        self.pool = kwargs.get('pool') or ConnectionPool()
+        # where output goes; anything with write(line) and flush() methods
+        self.output = kwargs.get('output')
+        self.write = self.output.write if self.output is not None else None
+        self.coordinator = kwargs.get('coordinator')
+        self.cache = kwargs.get('cache')
+        self.capture = Capture(kwargs['capture']) if kwargs.get('capture') else None
+        self.schedule = None
+        if kwargs.get('adaptive'):
+            self.schedule = PollSchedule(kwargs['adaptive'],
+                                         kwargs.get('max_backoff', ADAPTIVE_MAX_BACKOFF))
+        self.revisions = None
+        if kwargs.get('early') or kwargs.get('revisions'):
+            self.revisions = RevisionTracker(kwargs.get('revisions'))
+
+        # These two functions are defined in here so that the decorator can take CLI options,
+        # passed in from main(); we'll re-use the interval to sleep at the bottom of the loop
+        # that calls get_metric_statistics.
+        @retry(wait_exponential_multiplier=kwargs.get('interval', None),
+               wait_exponential_max=kwargs.get('max_interval', None),
+               # give up at the point the next cron of this script probably runs; Period is
+               # minutes; some_max_delay needs ms
+               stop_max_delay=cli_options['Count'] * cli_options['Period'] * 60 * 1000)
+        def get_metric_statistics(**kwargs):
+            """
+            A thin wrapper around boto.cloudwatch.connection.get_metric_statistics, for the
+            purpose of adding the @retry decorator
+            :param kwargs:
+            :return:
+            """
+            connection = kwargs.pop('connection')
+            return connection.get_metric_statistics(**kwargs)
+
+        @retry(wait_exponential_multiplier=kwargs.get('interval', None),
+               wait_exponential_max=kwargs.get('max_interval', None),
+               stop_max_delay=cli_options['Count'] * cli_options['Period'] * 60 * 1000)
+        def get_logs_statistics(**kwargs):
+            """
+            A thin wrapper around boto.logs.get_log_events, for the
+            purpose of adding the @retry decorator
+            :param kwargs:
+            :return:
+            """
+            connection = kwargs.pop('connection')
+            return connection.get_log_events(**kwargs)
+
+        self.get_metric_statistics = get_metric_statistics
+        self.get_logs_statistics = get_logs_statistics
+        if kwargs.get('stream'):
+            # the config gets read as it is run, by run_stream(), which
+            # connects once it knows the Auth
+            self.config_options = None
+            self.enhanced_monitoring = False
+            self.aggregator = Aggregator([])
+        else:
+            try:
+                self.reload(get_config(self.config_file))
+            except ValueError as e:
+                sys.stderr.write('ERROR: {0}: {1}\n'.format(self.config_file, e))
+                sys.exit(2)
+
+    def get_aggregator(self, config):
+        """
+        Get an Aggregator for the Rollups and Derived in `config`, reusing ours if
+        they did not change.
+        """
+        rollups = config.get('Rollups') or []
+        derived = config.get('Derived') or []
+        aggregator = getattr(self, 'aggregator', None)
+        if aggregator is None or aggregator.rollups != rollups or aggregator.derived != derived:
+            aggregator = Aggregator(rollups, derived)
+        return aggregator
+
+    def configure(self, config, aggregator=None):
+        """Set up everything in `config` except for its Metrics."""
+        # anything wrong with the config should fail before anything changes
+        aggregator = aggregator or self.get_aggregator(config)
+        check_list_controls((config.get('EnhancedMonitoring') or {}).get('Lists'))
+
+        self.config_options = config.get('Options')
+        self.enhanced_monitoring = config.get('EnhancedMonitoring', False)
+        auth_options = config.get('Auth', {})
+        if auth_options != self.auth_options:
+            self.auth_options = auth_options
+            self.region = auth_options.get('region', DEFAULT_REGION)
+            self.connect()
+        self.aggregator = aggregator
+
+    def reload(self, config=None):
+        """
+        Read the config file again, or use `config`, keeping the queries that
+        did not change.
+
+        Returns the keys of the queries that were added, removed and changed.
+        Raises one of CONFIG_ERRORS, with nothing changed, if the config file
+        can't be read or has something wrong with it.
+        """
+        if config is None:
+            config = load_config(self.config_file)
+        if not isinstance(config, dict):
+            raise ValueError('{0} is empty or not a YAML mapping'.format(self.config_file))
+        aggregator = self.get_aggregator(config)
+        shard = self.kwargs.get('shard')
+        queries = OrderedDict(
+            (key, query) for key, query in get_queries(config, self.cli_options).items()
+            if shard is None or in_shard(shard_key(key, query[0], aggregator), shard))
+        self.configure(config, aggregator)
+        added = [key for key in queries if key not in self.queries]
+        removed = [key for key in self.queries if key not in queries]
+        changed = [key for key in queries
+                   if key in self.queries and queries[key] != self.queries[key]]
+        for key in removed:
+            del self.queries[key]
+        if self.schedule is not None:
+            self.schedule.forget(removed)
+        if self.revisions is not None:
+            self.revisions.forget(removed)
+        for key in added + changed:
+            self.queries[key] = queries[key]
+        return added, removed, changed
+
+    def connect(self):
+        connect_args = {
+            'debug': 2 if self.verbose else 0,
+        }
+        if 'aws_access_key_id' in self.auth_options:
+            connect_args['aws_access_key_id'] = self.auth_options['aws_access_key_id']
+        if 'aws_secret_access_key' in self.auth_options:
+            connect_args['aws_secret_access_key'] = self.auth_options['aws_secret_access_key']
+        self.connect_args = connect_args
+        if self.kwargs.get('replay'):
+            return  # replays never call AWS
+        # make the first connection now, so bad Auth fails before any queries
+        with self.cloudwatch():
+            pass
+
+    def cloudwatch(self):
+        """Borrow a CloudWatch connection from the pool, for a `with` block."""
+        return self.pool.connection(CLOUDWATCH_CONNECT, self.region, **self.connect_args)
+
+    def run(self):
+        """
+        Fetch and output every query once.
+
+        Returns False if the run stopped early to hand over to another run.
+        """
+        self.aggregator.reset()
+        if self.capture is not None:
+            self.capture.start()
+        for key, (metric, options) in list(self.queries.items()):
+            if not self.run_query(key, metric, options):
+                return False
+        return self.finish_run()
+
+    def run_stream(self):
+        """
+        Like run(), but reading the config file as it goes, so each metric
+        gets fetched as soon as it is read and the config never has to fit
+        in memory. Anything other than Metrics only applies to the metrics
+        after it in the file.
+        """
+        config = {}
+        seen_metrics = False
+        for section, value in iter_config(self.config_file):
+            if section != 'Metrics':
+                if seen_metrics and section in ('Auth', 'Options'):
+                    sys.stderr.write(
+                        'WARNING: {0} after Metrics only applies to the metrics after it\n'.format(
+                            section))
+                config[section] = value
+                self.configure(config)
+                continue
+            if not seen_metrics:
+                seen_metrics = True
+                if self.auth_options is None:
+                    self.configure(config)
+                self.aggregator.reset()
+                if self.capture is not None:
+                    self.capture.start()
+            queries = get_queries({'Options': self.config_options, 'Metrics': [value]},
+                                  self.cli_options)
+            for key, (metric, options) in queries.items():
+                shard = self.kwargs.get('shard')
+                if shard is not None and not in_shard(shard_key(key, metric, self.aggregator),
+                                                      shard):
+                    continue
+                if not self.run_query(key, metric, options):
+                    return False
+        return self.finish_run()
+
+    def run_query(self, key, metric, options):
+        """Fetch and output one query, returning False if another run took over."""
+        coordinator = self.coordinator
+        if coordinator is not None:
+            if coordinator.superseded():
+                return False
+            if key in coordinator.completed:
+                return True
+        if self.schedule is None or self.schedule.due(key):
+            self.fetch_metric(metric, options)
+            self.flush()
+            time.sleep(self.kwargs.get('interval', 0) / 1000.0)
+        if coordinator is not None:
+            coordinator.complete(key)
+        return True
+
+    def finish_run(self):
+        """Output the rollups, and fetch Enhanced Monitoring, once all the metrics are done."""
+        coordinator = self.coordinator
+        if coordinator is not None and coordinator.took_over_from is not None:
+            # the old run had some of the members, so these would be partial
+            # rollups under the same names as whole ones
+            if self.aggregator.groups or self.aggregator.derived_groups:
+                sys.stderr.write(
+                    'WARNING: skipping Rollups and Derived metrics for a run that took over\n')
+        else:
+            self.aggregator.output(self.write)
+        self.flush()
+        if self.schedule is not None:
+            self.schedule.save()
+        if self.revisions is not None:
+            self.revisions.save()
+
+        # get enhanced monitoring if it is enabled
+        done = coordinator is not None and 'EnhancedMonitoring' in coordinator.completed
+        if self.enhanced_monitoring and not done:
+            self.fetch_enhanced_monitoring()
+            if coordinator is not None:
+                coordinator.complete('EnhancedMonitoring')
+        self.flush()
+        if self.capture is not None:
+            self.capture.finish()
+        return True
+
+    def flush(self):
+        if self.output is not None:
+            self.output.flush()
+
+    def fetch_metric(self, metric, options):
+        key = query_key(metric, options)
+        request = self.metric_request(key, metric, options)
+        results = self.get_cached_metric_statistics(**request)
+        if self.capture is not None:
+            self.capture.record('GetMetricStatistics', request, results, key=key)
+        self.output_metric(key, metric, options, results, request['start_time'],
+                           request['end_time'])
+
+    def metric_request(self, key, metric, options):
+        """Get the get_metric_statistics() arguments for the query `key`."""
         period_local = options['Period'] * 60
         count_local = options['Count']
-        log_group = enhanced_monitoring['LogGroup']
+        # if you have metrics that are available only every 5 minutes, be sure to request only stats
+        # that are likely/sure to be up to date, ie ones ending on the previous
+        # period increment.
+        now = int(time.time())
+        end_time = datetime.datetime.utcfromtimestamp(now - now % period_local)
+        if self.kwargs.get('early'):
+            # include the period in progress too; it gets revised on the
+            # following runs, for as long as it is within Count periods
+            end_time += datetime.timedelta(seconds=period_local)
+        start_time = end_time - datetime.timedelta(seconds=period_local * count_local)
+        if self.schedule is not None and self.schedule.since(key) is not None:
+            # polls may have been skipped, so reach back to the latest datapoint we saw
+            since = datetime.datetime.utcfromtimestamp(self.schedule.since(key))
+            earliest = end_time - datetime.timedelta(seconds=period_local * MAX_DATAPOINTS)
+            start_time = max(min(start_time, since), earliest)
+
+        return dict(
+            period=period_local,
+            start_time=start_time,
+            end_time=end_time,
+            metric_name=metric['MetricName'],
+            namespace=metric['Namespace'],
+            statistics=metric['Statistics'],
+            dimensions=metric['Dimensions'],
+            # if 'Unit 'is in the config, request only that; else get all units
+            unit=metric.get('Unit')
+        )
+
+    def output_metric(self, key, metric, options, results, start_time, end_time):
+        """Output the `results` of fetching `metric` from `start_time` to `end_time`."""
+        period_local = options['Period'] * 60
+        metric_name = metric['MetricName']
+        if self.schedule is not None:
+            self.schedule.observe(key, results, period_local)
+
+        if 'NullIsZero' in options and metric_name in options['NullIsZero']:
+            results = value_pad_results(
+                results,
+                start_time,
+                end_time,
+                options['NullIsZero'][metric_name],
+            )
+
+        if self.aggregator.observe(results, metric):
+            return
+        if self.revisions is not None:
+            results = self.revisions.revise(key, results, timegm(start_time.timetuple()))
+        output_results(results, metric, options, self.write)
+
+    def cache_scope(self):
+        """What, besides the query, the response cache needs to tell responses apart."""
+        return [self.region, self.auth_options.get('aws_access_key_id')]
+
+    def get_cached_metric_statistics(self, **kwargs):
+        """Call get_metric_statistics(), through the response cache if there is one."""
+        with self.cloudwatch() as conn:
+            kwargs['connection'] = conn
+            if self.cache is None:
+                return self.get_metric_statistics(**kwargs)
+            return self.cache.fetch(self.cache_scope(), self.get_metric_statistics, **kwargs)
+
+    def enhanced_monitoring_options(self):
+        enhanced_monitoring = self.enhanced_monitoring or {}
+        options = get_options(self.config_options, None, self.cli_options)
         # determine formatter
         if 'Formatter' in enhanced_monitoring:
             options['Formatter'] = enhanced_monitoring['Formatter']
@@ -400,6 +2528,17 @@ def leadbutt(config_file, cli_options, verbose=False, **kwargs):
         # determine if there is a custom formatter for logs in list form
         if 'ListFormatter' in enhanced_monitoring:
             options['ListFormatter'] = enhanced_monitoring['ListFormatter']
+        # per category controls on which entries of list categories get output
+        options['Lists'] = enhanced_monitoring.get('Lists') or {}
+        return options
+
+    def fetch_enhanced_monitoring(self):
+        enhanced_monitoring = self.enhanced_monitoring
+        options = self.enhanced_monitoring_options()
+        # convert minutes to seconds
+        period_local = options['Period'] * 60
+        count_local = options['Count']
+        log_group = enhanced_monitoring['LogGroup']
 
         # if you have metrics that are available only every 5 minutes, be sure to request only stats
         # that are likely/sure to be up to date, ie ones ending on the previous period increment.
@@ -407,44 +2546,372 @@ def leadbutt(config_file, cli_options, verbose=False, **kwargs):
         end_time = int((datetime.datetime.now() - datetime.timedelta(seconds=int(time.time()) % period_local)).strftime("%s")) * 1000
         start_time = end_time - (period_local * count_local * 1000)
         # connect to endpoint
-        logs_conn = boto.logs.connect_to_region(region)
-        # get all streams in log group
-        log_streams = logs_conn.describe_log_streams(log_group_name=log_group)
-        # pluck only stream names out
-        streams = [log['logStreamName'] for log in log_streams['logStreams']]
-        # retrieve logs for this time period from all streams
-
-        for stream in streams:
-            results = get_logs_statistics(
-                connection=logs_conn,
-                start_from_head=False,
-                limit=50,
-                start_time=start_time,
-                end_time=end_time,
-                log_stream_name=stream,
-                log_group_name=log_group
-            )
-            process_log_results(results['events'], options)
-            time.sleep(0.5)  # rate limiting
+        connect_logs = load_plugin('leadbutt.log_backends',
+                                   enhanced_monitoring.get('Backend', DEFAULT_LOG_BACKEND),
+                                   LOG_BACKENDS)
+        with self.pool.connection(connect_logs, self.region) as logs_conn:
+            # get all streams in log group
+            log_streams = logs_conn.describe_log_streams(log_group_name=log_group)
+            # pluck only stream names out
+            streams = [log['logStreamName'] for log in log_streams['logStreams']
+                       if in_shard(log['logStreamName'], self.kwargs.get('shard'))]
+            # retrieve logs for this time period from all streams
+
+            for stream in streams:
+                request = dict(
+                    start_from_head=False,
+                    limit=50,
+                    start_time=start_time,
+                    end_time=end_time,
+                    log_stream_name=stream,
+                    log_group_name=log_group
+                )
+                results = self.get_logs_statistics(connection=logs_conn, **request)
+                if self.capture is not None:
+                    self.capture.record('GetLogEvents', request, results)
+                process_log_results(results['events'], options, self.write)
+                self.flush()
+                time.sleep(0.5)  # rate limiting
+
+
+# Fetch engines, picked with --engine. Like LOG_BACKENDS, engines can be
+# 'module:class' strings, so leadbutt_async only gets imported when used, and
+# third party engines can register a `leadbutt.engines` entry point.
+ENGINES = {
+    'boto': Runner,
+    'asyncio': 'leadbutt_async:AsyncRunner',
+}
+DEFAULT_ENGINE = 'boto'
+
+
+def make_runner(config_file, cli_options, verbose=False, **kwargs):
+    """Make a Runner, of the class for the `engine` in `kwargs`."""
+    runner_class = load_plugin('leadbutt.engines', kwargs.get('engine') or DEFAULT_ENGINE, ENGINES)
+    return runner_class(config_file, cli_options, verbose, **kwargs)
+
+
+def leadbutt(config_file, cli_options, verbose=False, **kwargs):
+    if not isinstance(config_file, string_types):
+        # several config files run one after the other, sharing the output and cache
+        return all([leadbutt(path, cli_options, verbose, **kwargs) for path in config_file])
+    runner = make_runner(config_file, cli_options, verbose, **kwargs)
+    if kwargs.get('stream'):
+        return runner.run_stream()
+    return runner.run()
+
+
+def replay(directory, config_file, cli_options, verbose=False, **kwargs):
+    """
+    Output the responses recorded in `directory` by --capture, as fast as
+    they can be parsed, formatted and output, without calling AWS.
+
+    The config decides how they are formatted, so history can be output
+    again after a Formatter changes. Recorded metrics that are not in the
+    config get its default Options.
+    """
+    runner = Runner(config_file, cli_options, verbose, replay=True, **kwargs)
+    # a changed Formatter changes the query key, so fall back to finding the
+    # queries that would have made the same request
+    by_request = {}
+    for key, (metric, options) in runner.queries.items():
+        by_request.setdefault(request_key(metric, options), []).append(key)
+    started = time.time()
+    responses = 0
+    segment = None
+    replayed = set()
+    for name, record in iter_capture(directory):
+        if name != segment:
+            # each segment is a run, with rollups of its own
+            if segment is not None:
+                runner.aggregator.output(runner.write)
+            runner.aggregator.reset()
+            segment = name
+            replayed.clear()
+        request = record['request']
+        if record['kind'] == 'GetMetricStatistics':
+            key = record['key']
+            if key not in runner.queries:
+                matches = [match for match in by_request.get(recorded_request_key(request), [])
+                           if match not in replayed]
+                if matches:
+                    key = matches[0]
+            replayed.add(key)
+            if key in runner.queries:
+                metric, options = runner.queries[key]
+            else:
+                metric = {
+                    'Namespace': request['namespace'],
+                    'MetricName': request['metric_name'],
+                    'Statistics': request['statistics'],
+                    'Dimensions': request['dimensions'],
+                }
+                if request.get('unit'):
+                    metric['Unit'] = request['unit']
+                options = get_options(runner.config_options, None, cli_options)
+            results = [
+                dict(result, Timestamp=datetime.datetime.utcfromtimestamp(result['Timestamp']))
+                for result in record['response']]
+            runner.output_metric(key, metric, options, results,
+                                 datetime.datetime.utcfromtimestamp(request['start_time']),
+                                 datetime.datetime.utcfromtimestamp(request['end_time']))
+        elif record['kind'] == 'GetLogEvents':
+            process_log_results(record['response']['events'], runner.enhanced_monitoring_options(),
+                                runner.write)
+        responses += 1
+    runner.aggregator.output(runner.write)
+    runner.flush()
+    if verbose:
+        elapsed = time.time() - started
+        sys.stderr.write('Replayed {0} responses in {1:.2f}s, {2:.0f} per second\n'.format(
+            responses, elapsed, responses / elapsed if elapsed else 0))
+    return True
+
+
+def write_pid_file(pid_file):
+    with open(pid_file, 'w') as fp:
+        fp.write('{0}\n'.format(os.getpid()))
+
+
+def daemon(config_file, cli_options, verbose=False, pid_file=None, **kwargs):
+    """
+    Run `config_file`, or a list of config files one after the other,
+    every period, forever.
+
+    Sending the process a SIGHUP reloads the config files before the next
+    run; queries that are running carry on, and only the queries that changed
+    are swapped out.
+    """
+    config_files = [config_file] if isinstance(config_file, string_types) else config_file
+    runners = [make_runner(path, cli_options, verbose, **kwargs) for path in config_files]
+    reload_requested = []
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.append(signum))
+    if pid_file:
+        write_pid_file(pid_file)
+    period = cli_options['Period'] * 60
+    while True:
+        reload = bool(reload_requested) and not kwargs.get('stream')
+        del reload_requested[:]
+        for runner in runners:
+            if reload:
+                try:
+                    added, removed, changed = runner.reload()
+                except CONFIG_ERRORS as e:
+                    sys.stderr.write(
+                        'ERROR: could not reload {0}, keeping its previous queries: {1}\n'.format(
+                            runner.config_file, e))
+                else:
+                    if verbose:
+                        sys.stderr.write(
+                            'Reloaded {0}: {1} added, {2} removed, {3} changed\n'.format(
+                                runner.config_file, len(added), len(removed), len(changed)))
+            if not (runner.run_stream() if kwargs.get('stream') else runner.run()):
+                sys.stderr.write('Handing {0} over to another run\n'.format(runner.config_file))
+                runner.coordinator.release(done=False)
+                return
+            if runner.coordinator is not None:
+                runner.coordinator.next_run()
+        if verbose and isinstance(kwargs.get('output'), FanOut):
+            output_sink_stats(kwargs['output'])
+        if verbose and kwargs.get('cache') is not None:
+            output_cache_stats(kwargs['cache'])
+        # sleep until the start of the next period
+        time.sleep(period - time.time() % period)
+
+
+def supervise(command, processes, restart=False, output=None):
+    """
+    Run `command` once per shard in `processes` processes.
+
+    Each process gets `--shard I/N` added to `command`, and their output is
+    merged a line at a time into stdout, or into `output`, like a
+    SpoolingOutput, if it is set. If `restart` is set, processes that
+    fail get started again, until the supervisor gets a SIGTERM. SIGHUP and
+    SIGTERM are passed on to the processes.
+    Returns the worst exit status, counting a process killed by a signal as
+    128 plus the signal number, like a shell does.
+    """
+    import subprocess
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    lock = threading.Lock()
+
+    def pump(stream):
+        for line in iter(stream.readline, b''):
+            with lock:
+                if output is not None:
+                    output.write(line.decode('utf-8'))
+                    output.flush()
+                else:
+                    out.write(line)
+                    out.flush()
+
+    def start(index):
+        proc = subprocess.Popen(command + ['--shard', '{0}/{1}'.format(index, processes)],
+                                stdout=subprocess.PIPE)
+        thread = threading.Thread(target=pump, args=(proc.stdout,))
+        thread.daemon = True
+        thread.start()
+        return proc, thread
+
+    workers = {}
+    stopping = []
+
+    def forward(signum, frame):
+        if signum == signal.SIGTERM:
+            stopping.append(signum)
+        for proc, thread in workers.values():
+            proc.send_signal(signum)
+    previous_handlers = dict((signum, signal.signal(signum, forward))
+                             for signum in (signal.SIGHUP, signal.SIGTERM))
+    for index in range(1, processes + 1):
+        if stopping:
+            break
+        workers[index] = start(index)
+
+    status = 0
+    while workers:
+        for index, (proc, thread) in list(workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            thread.join()
+            if code and restart and not stopping:
+                sys.stderr.write('shard {0}/{1} exited with {2}, restarting\n'.format(
+                    index, processes, code))
+                workers[index] = start(index)
+            else:
+                del workers[index]
+                status = max(status, code if code >= 0 else 128 - code)
+        time.sleep(0.1)
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+    return status
+
+
+def strip_option(argv, option):
+    """Remove `option` and its value from a list of command line arguments."""
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            stripped.append(arg)
+    return stripped
 
 
 def main(*args, **kwargs):
     options = docopt(__doc__, version=__version__)
     # help: http://boto.readthedocs.org/en/latest/ref/cloudwatch.html#boto.ec2.cloudwatch.CloudWatchConnection.get_metric_statistics
-    config_file = options.pop('--config-file')
+    config_files = options.pop('--config-file')
+    # one config file, or a list of them to run one after the other
+    config_file = config_files[0] if len(config_files) == 1 else config_files
     period = int(options.pop('--period'))
     count = int(options.pop('-n'))
     verbose = options.pop('-v')
+    interval = float(options.pop('-i'))
+    max_interval = float(options.pop('-m'))
 
     cli_options = {}
     if period is not None:
         cli_options['Period'] = period
     if count is not None:
         cli_options['Count'] = count
-    leadbutt(config_file, cli_options, verbose,
-             interval=float(options.pop('-i')),
-             max_interval=float(options.pop('-m'))
-             )
+    one_config_only = options['--plan'] or options['--replay'] or options['--overlap'] != 'allow'
+    if len(config_files) > 1 and one_config_only:
+        sys.stderr.write(
+            'ERROR: --plan, --replay and --overlap work with one config file at a time\n')
+        sys.exit(2)
+    if options.pop('--plan'):
+        report = plan(config_file, cli_options, interval=interval, max_interval=max_interval)
+        output_plan(report)
+        sys.exit(0 if report['fits'] else PLAN_EXIT_CODE)
+    spool = None
+    if options['--spool'] and not options['--sink']:
+        spool = Spool(options['--spool'], max_bytes=int(options['--spool-max-bytes']),
+                      max_age=int(options['--spool-max-age']))
+    if options['--processes'] and any(url.startswith('serve://') for url in options['--sink']):
+        sys.stderr.write('ERROR: every shard would serve on the same port, so serve:// does not '
+                         'work with --processes\n')
+        sys.exit(2)
+    if options['--processes']:
+        # the supervisor owns the pid file and the stdout spool, and passes
+        # SIGHUP on to the shards
+        argv = sys.argv[1:]
+        for option in ('--processes', '--pid-file', '--spool'):
+            argv = strip_option(argv, option)
+        command = [sys.executable, os.path.abspath(__file__)] + argv
+        if options['--pid-file']:
+            write_pid_file(options['--pid-file'])
+        output = None
+        if spool is not None:
+            output = SpoolingOutput(write_stdout, spool, drain_rate=int(options['--drain-rate']))
+        sys.exit(supervise(command, int(options['--processes']), restart=options['--daemon'],
+                           output=output))
+
+    shard = parse_shard(options['--shard']) if options['--shard'] else None
+    run_kwargs = {
+        'interval': interval,
+        'max_interval': max_interval,
+        'shard': shard,
+        'adaptive': shard_path(options['--adaptive'], shard) if options['--adaptive'] else None,
+        'max_backoff': int(options['--max-backoff']),
+        'stream': options['--stream'],
+        'early': options['--early'],
+        'revisions': shard_path(options['--revisions'], shard) if options['--revisions'] else None,
+        'capture': options['--capture'],
+        'pool': default_pool,
+        'engine': options['--engine'],
+        'in_flight': int(options['--in-flight']),
+    }
+    if len(config_files) > 1:
+        ttl = float(options['--cache-ttl']) if options['--cache-ttl'] else period * 60
+        run_kwargs['cache'] = ResponseCache(int(options['--cache-size']), ttl)
+    if options['--sink']:
+        run_kwargs['output'] = FanOut([get_sink_worker(url, shard) for url in options['--sink']])
+    elif spool is not None:
+        run_kwargs['output'] = SpoolingOutput(write_stdout, spool,
+                                              drain_rate=int(options['--drain-rate']))
+    try:
+        load_plugin('leadbutt.engines', run_kwargs['engine'], ENGINES)
+    except KeyError:
+        sys.stderr.write('ERROR: unknown --engine {0}\n'.format(run_kwargs['engine']))
+        sys.exit(2)
+    except SyntaxError:
+        sys.stderr.write('ERROR: --engine {0} needs a newer Python\n'.format(run_kwargs['engine']))
+        sys.exit(2)
+    if options['--overlap'] not in ('allow', 'skip', 'takeover'):
+        sys.stderr.write('ERROR: --overlap must be allow, skip or takeover\n')
+        sys.exit(2)
+    if options['--overlap'] != 'allow':
+        coordinator = RunCoordinator(config_file, options['--lock-dir'], run_kwargs['shard'])
+        if not coordinator.acquire(takeover=options['--overlap'] == 'takeover',
+                                   timeout=period * 60):
+            sys.stderr.write('The last run of {0} is still going, skipping this one\n'.format(
+                config_file))
+            sys.exit(0)
+        if coordinator.took_over_from is not None and verbose:
+            sys.stderr.write('Took over from {0}, which completed {1} queries\n'.format(
+                coordinator.took_over_from, len(coordinator.completed)))
+        run_kwargs['coordinator'] = coordinator
+    if options['--replay']:
+        replay(options['--replay'], config_file, cli_options, verbose, **run_kwargs)
+        if options['--sink']:
+            run_kwargs['output'].close()
+    elif options.pop('--daemon'):
+        daemon(config_file, cli_options, verbose, pid_file=options.pop('--pid-file'), **run_kwargs)
+    else:
+        done = leadbutt(config_file, cli_options, verbose, **run_kwargs)
+        if 'coordinator' in run_kwargs:
+            run_kwargs['coordinator'].release(done=done)
+        if options['--sink']:
+            run_kwargs['output'].close()
+            if verbose:
+                output_sink_stats(run_kwargs['output'])
+        if verbose and 'cache' in run_kwargs:
+            output_cache_stats(run_kwargs['cache'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,437 @@
+# -*- coding: UTF-8 -*-
+"""
+An asyncio fetch engine for leadbutt, picked with `leadbutt --engine=asyncio`.
+
+boto 2 makes one blocking request at a time per connection, so most of a run
+is spent waiting on CloudWatch. This engine signs its own requests (AWS
+Signature Version 4) and keeps up to --in-flight of them going at once over
+keep-alive connections, within the documented request rate limits. Results go
+through the same output path as the boto engine.
+
+Needs Python 3.5 or newer.
+"""
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import ssl
+import threading
+import time
+from concurrent.futures import wait
+from urllib.parse import urlencode, urlsplit
+from xml.etree import ElementTree
+
+import leadbutt
+
+
+# where requests go, by service; tests point these at a local server
+ENDPOINTS = {
+    'monitoring': 'https://monitoring.{region}.amazonaws.com/',
+    'logs': 'https://logs.{region}.amazonaws.com/',
+}
+IN_FLIGHT = 500
+REQUEST_TIMEOUT = 30  # seconds
+CLOUDWATCH_API_VERSION = '2010-08-01'
+CLOUDWATCH_NAMESPACE = '{http://monitoring.amazonaws.com/doc/2010-08-01/}'
+STATISTICS = ('Average', 'Sum', 'SampleCount', 'Maximum', 'Minimum')
+
+
+def sign(method, url, headers, body, region, service, credentials, now=None):
+    """
+    Sign a request with AWS Signature Version 4.
+
+    Returns a copy of `headers` with the Host, X-Amz-Date, Authorization and,
+    for temporary credentials, X-Amz-Security-Token headers added.
+    `credentials` is an (access key, secret key, token) tuple.
+    """
+    access_key, secret_key, token = credentials
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    datestamp = now.strftime('%Y%m%d')
+    parsed = urlsplit(url)
+
+    headers = dict(headers)
+    headers['Host'] = parsed.netloc
+    headers['X-Amz-Date'] = amz_date
+    if token:
+        headers['X-Amz-Security-Token'] = token
+    canonical_headers = sorted((name.lower(), ' '.join(str(value).split()))
+                               for name, value in headers.items())
+    signed_headers = ';'.join(name for name, value in canonical_headers)
+    canonical_query = '&'.join(sorted(parsed.query.split('&'))) if parsed.query else ''
+    canonical_request = '\n'.join([
+        method,
+        parsed.path or '/',
+        canonical_query,
+        ''.join('{0}:{1}\n'.format(name, value) for name, value in canonical_headers),
+        signed_headers,
+        hashlib.sha256(body).hexdigest(),
+    ])
+    scope = '{0}/{1}/{2}/aws4_request'.format(datestamp, region, service)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (datestamp, region, service, 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}'.format(
+            access_key, scope, signed_headers, signature))
+    return headers
+
+
+def get_credentials(auth_options):
+    """
+    Get a function returning the (access key, secret key, token) to sign
+    with: from Auth in the config, or wherever boto would find them, which
+    includes instance profiles, whose credentials boto refreshes.
+    """
+    if 'aws_access_key_id' in auth_options:
+        credentials = (auth_options['aws_access_key_id'], auth_options['aws_secret_access_key'],
+                       None)
+        return lambda: credentials
+
+    import boto.provider
+
+    provider = boto.provider.Provider('aws')
+    return lambda: (provider.access_key, provider.secret_key, provider.security_token)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, body):
+        super(HTTPError, self).__init__('HTTP {0}: {1}'.format(status, body[:200]))
+        self.status = status
+        self.body = body
+
+
+class HTTPClient(object):
+    """
+    A minimal HTTP/1.1 client on asyncio streams, keeping connections alive
+    between requests. Only made for the AWS APIs: bodies are small, and
+    either sized or chunked.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.ssl = ssl.create_default_context()
+
+    async def request(self, method, url, headers, body):
+        """Make a request, returning the status and body of the response."""
+        parsed = urlsplit(url)
+        https = parsed.scheme == 'https'
+        address = (parsed.hostname, parsed.port or (443 if https else 80), https)
+        head = '{0} {1} HTTP/1.1\r\n'.format(method, parsed.path or '/')
+        head += ''.join('{0}: {1}\r\n'.format(name, value) for name, value in headers.items())
+        head += 'Content-Length: {0}\r\n\r\n'.format(len(body))
+        data = head.encode('latin-1') + body
+
+        while True:
+            idle = self.idle.get(address)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    address[0], address[1], ssl=self.ssl if https else None)
+            try:
+                writer.write(data)
+                await writer.drain()
+                status, keep_alive, response = await self.read_response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection; try again on a new one
+        if keep_alive:
+            self.idle.setdefault(address, []).append((reader, writer))
+        else:
+            writer.close()
+        return status, response
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed')
+        version, status = status_line.decode('latin-1').split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+            sized = True
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+            sized = True
+        else:
+            body = await reader.read()
+            sized = False
+        connection = headers.get('connection', '').lower()
+        keep_alive = sized and connection != 'close' and (
+            version == 'HTTP/1.1' or connection == 'keep-alive')
+        return int(status), keep_alive, body
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+class RateLimiter(object):
+    """Spaces out calls to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = 0
+
+    async def wait(self):
+        now = time.time()
+        self.next_at = max(self.next_at, now)
+        delay = self.next_at - now
+        self.next_at += self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def parse_time(text):
+    return datetime.datetime.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_metric_statistics(body):
+    """Parse a GetMetricStatistics response into datapoints like boto's."""
+    results = []
+    for member in ElementTree.fromstring(body).iter(CLOUDWATCH_NAMESPACE + 'member'):
+        datapoint = {}
+        for element in member:
+            name = element.tag[len(CLOUDWATCH_NAMESPACE):]
+            if name == 'Timestamp':
+                datapoint[name] = parse_time(element.text)
+            elif name in STATISTICS:
+                datapoint[name] = float(element.text)
+            else:
+                datapoint[name] = element.text
+        results.append(datapoint)
+    return results
+
+
+def metric_statistics_params(request):
+    """The query API parameters for get_metric_statistics() arguments."""
+    params = [
+        ('Action', 'GetMetricStatistics'),
+        ('Version', CLOUDWATCH_API_VERSION),
+        ('Namespace', request['namespace']),
+        ('MetricName', request['metric_name']),
+        ('Period', request['period']),
+        ('StartTime', request['start_time'].strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ('EndTime', request['end_time'].strftime('%Y-%m-%dT%H:%M:%SZ')),
+    ]
+    statistics = request['statistics']
+    if not isinstance(statistics, list):
+        statistics = [statistics]
+    for i, statistic in enumerate(statistics, 1):
+        params.append(('Statistics.member.{0}'.format(i), statistic))
+    i = 1
+    for name, values in sorted((request['dimensions'] or {}).items()):
+        # like boto, a list of values is that many dimensions of the same name
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            params.append(('Dimensions.member.{0}.Name'.format(i), name))
+            if value is not None:
+                params.append(('Dimensions.member.{0}.Value'.format(i), value))
+            i += 1
+    if request.get('unit'):
+        params.append(('Unit', request['unit']))
+    return params
+
+
+class AsyncRunner(leadbutt.Runner):
+    """
+    A Runner that fetches with asyncio instead of boto.
+
+    The event loop runs in a thread of its own. run() and run_stream() hand
+    each query to it as they go, waiting only when --in-flight requests are
+    already going, so a streamed config keeps streaming. All output happens
+    on the loop's thread, and finish_run() waits for every query first.
+    """
+
+    def __init__(self, config_file, cli_options, verbose=False, **kwargs):
+        self.in_flight = kwargs.get('in_flight') or IN_FLIGHT
+        self.endpoints = dict(ENDPOINTS, **(kwargs.get('endpoints') or {}))
+        self.slots = threading.BoundedSemaphore(self.in_flight)
+        self.pending = []
+        self.http = HTTPClient()
+        self.limits = dict((action, RateLimiter(rate))
+                           for action, rate in leadbutt.PLAN_RATE_LIMITS.items())
+        # give up at about the point the next run starts, like the boto engine
+        self.max_delay = cli_options['Count'] * cli_options['Period'] * 60
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+        super(AsyncRunner, self).__init__(config_file, cli_options, verbose, **kwargs)
+
+    def connect(self):
+        # there are no boto connections to make, only credentials to sign with
+        self.credentials = get_credentials(self.auth_options)
+
+    def run_query(self, key, metric, options):
+        coordinator = self.coordinator
+        if coordinator is not None:
+            if coordinator.superseded():
+                self.wait()
+                return False
+            if key in coordinator.completed:
+                return True
+        if self.schedule is not None and not self.schedule.due(key):
+            if coordinator is not None:
+                coordinator.complete(key)
+            return True
+
+        self.slots.acquire()
+        future = asyncio.run_coroutine_threadsafe(self.fetch_metric_async(key, metric, options),
+                                                  self.loop)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.pending.append(future)
+        if len(self.pending) > 2 * self.in_flight:
+            # let go of the queries that are done, raising any errors now
+            pending = []
+            for future in self.pending:
+                if future.done():
+                    future.result()
+                else:
+                    pending.append(future)
+            self.pending = pending
+        return True
+
+    def wait(self):
+        """Wait for the queries in flight, raising the first error."""
+        pending, self.pending = self.pending, []
+        wait(pending)
+        for future in pending:
+            future.result()
+
+    def finish_run(self):
+        self.wait()
+        return super(AsyncRunner, self).finish_run()
+
+    async def fetch_metric_async(self, key, metric, options):
+        request = self.metric_request(key, metric, options)
+        results = self.cache.get(self.cache_scope(), **request) if self.cache is not None else None
+        if results is None:
+            results = await self.get_metric_statistics_async(request)
+            if self.cache is not None:
+                self.cache.put(self.cache_scope(), results, **request)
+        if self.capture is not None:
+            self.capture.record('GetMetricStatistics', request, results, key=key)
+        self.output_metric(key, metric, options, results, request['start_time'],
+                           request['end_time'])
+        if self.coordinator is not None:
+            self.coordinator.complete(key)
+
+    async def get_metric_statistics_async(self, request):
+        body = urlencode(metric_statistics_params(request)).encode('utf-8')
+        headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'}
+        response = await self.call('monitoring', 'GetMetricStatistics', headers, body)
+        return parse_metric_statistics(response)
+
+    async def call_logs(self, action, params):
+        headers = {
+            'Content-Type': 'application/x-amz-json-1.1',
+            'X-Amz-Target': 'Logs_20140328.{0}'.format(action),
+        }
+        response = await self.call('logs', action, headers, json.dumps(params).encode('utf-8'))
+        return json.loads(response.decode('utf-8'))
+
+    async def call(self, service, action, headers, body):
+        """
+        Make a signed request, within the rate limit for `action`, retrying
+        throttling and server errors with exponential backoff.
+        """
+        url = self.endpoints[service].format(region=self.region)
+        interval = self.kwargs.get('interval') or 0
+        max_interval = self.kwargs.get('max_interval') or 0
+        give_up_at = time.time() + self.max_delay
+        attempt = 0
+        while True:
+            await self.limits[action].wait()
+            signed = sign('POST', url, headers, body, self.region, service, self.credentials())
+            try:
+                status, response = await asyncio.wait_for(
+                    self.http.request('POST', url, signed, body), REQUEST_TIMEOUT)
+                if status == 200:
+                    return response
+                error = HTTPError(status, response)
+                if status < 500 and b'Throttl' not in response:
+                    raise error
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                error = e
+            attempt += 1
+            delay = min(interval * 2 ** attempt, max_interval) / 1000.0
+            if time.time() + delay > give_up_at:
+                raise error
+            await asyncio.sleep(delay)
+
+    def fetch_enhanced_monitoring(self):
+        backend = self.enhanced_monitoring.get('Backend', leadbutt.DEFAULT_LOG_BACKEND)
+        if backend != leadbutt.DEFAULT_LOG_BACKEND:
+            # other backends are plugins with a boto style interface
+            return super(AsyncRunner, self).fetch_enhanced_monitoring()
+        asyncio.run_coroutine_threadsafe(self.fetch_enhanced_monitoring_async(), self.loop).result()
+
+    async def fetch_enhanced_monitoring_async(self):
+        options = self.enhanced_monitoring_options()
+        period_local = options['Period'] * 60
+        log_group = self.enhanced_monitoring['LogGroup']
+        now = int(time.time())
+        end_time = (now - now % period_local) * 1000
+        start_time = end_time - (period_local * options['Count'] * 1000)
+
+        log_streams = await self.call_logs('DescribeLogStreams', {'logGroupName': log_group})
+        streams = [log['logStreamName'] for log in log_streams['logStreams']
+                   if leadbutt.in_shard(log['logStreamName'], self.kwargs.get('shard'))]
+        slots = asyncio.Semaphore(self.in_flight)
+
+        async def fetch_stream(stream):
+            request = dict(
+                start_from_head=False,
+                limit=50,
+                start_time=start_time,
+                end_time=end_time,
+                log_stream_name=stream,
+                log_group_name=log_group
+            )
+            async with slots:
+                results = await self.call_logs('GetLogEvents', {
+                    'logGroupName': log_group,
+                    'logStreamName': stream,
+                    'startTime': start_time,
+                    'endTime': end_time,
+                    'limit': 50,
+                    'startFromHead': False,
+                })
+            if self.capture is not None:
+                self.capture.record('GetLogEvents', request, results)
+            leadbutt.process_log_results(results['events'], options, self.write)
+
+        await asyncio.gather(*[fetch_stream(stream) for stream in streams])
@@ -21,20 +21,25 @@ in documentation or tests.
 from tempfile import NamedTemporaryFile
 import os
 
-import boto
-import boto.regioninfo
-
-from leadbutt import leadbutt
+from leadbutt import default_pool, leadbutt
 from plumbum import get_jinja_template, get_template_tokens, interpret_options, CliArgsException
 
 
-def list_beanstalk(region, environment_name_args):
-    # args are named differently here as the use case is that we want attributes for exactly one environment
+def connect_beanstalk(region):
+    import boto
+    import boto.regioninfo
+
     region_info = boto.regioninfo.RegionInfo(None, region, 'elasticbeanstalk.{}.amazonaws.com'.format(region))
-    eb_conn = boto.connect_beanstalk(
+    return boto.connect_beanstalk(
         region=region_info,
     )
-    environments = eb_conn.describe_environment_resources(**environment_name_args)
+
+
+def list_beanstalk(region, environment_name_args):
+    # args are named differently here as the use case is that we want attributes for exactly
+    # one environment
+    with default_pool.connection(connect_beanstalk, region) as eb_conn:
+        environments = eb_conn.describe_environment_resources(**environment_name_args)
     resources = environments['DescribeEnvironmentResourcesResponse']['DescribeEnvironmentResourcesResult']['EnvironmentResources']
     return resources
 
@@ -74,5 +79,5 @@ def main():
     tempfile.write(jinja_template.render(get_template_tokens(base_tokens=base_tokens, cli_tokens=cli_tokens)))
     tempfile.flush()
     # TODO: not hardcoding the Perdiod and Count requies a refactor of leabutt.py into a class with a config object.
-    leadbutt(tempfile.name, {'Period': 1, 'Count': 5}, verbose=False)
+    leadbutt(tempfile.name, {'Period': 1, 'Count': 5}, verbose=False, pool=default_pool)
     tempfile.close()
@@ -26,31 +26,74 @@ They're written in jinja2, and have these variables available:
   filters    A dictionary of the filters that were passed in
   region     The region the resource is located in
   resources  A list of the resources as boto objects
+
+ELB and RDS resources get a `tags` dict too. The first time any of them is
+used, the tags of every resource in the listing are fetched at once, and kept
+for `--tag-ttl` seconds.
+
+Batch Mode:
+
+To render many templates in one go, pass a YAML manifest with a list of jobs
+instead of a template and namespace:
+
+  plumbum --manifest jobs.yml
+
+Each job has a `template` and `namespace`, and optionally a `region`, a dict
+of `filters`, a dict of `tokens`, an `output` file (defaults to stdout) and
+a `format`.
+Jobs share compiled templates and the resources listed for a namespace,
+region and filter combination.
+
+Watch Mode:
+
+To keep a config up to date as resources come and go, poll for resources
+every so many seconds and rewrite the config when its metrics change:
+
+  plumbum --watch 300 --output ec2.yml --pid-file leadbutt.pid ec2.yml.j2 ec2
+
+If a `--pid-file` is given, that process (usually `leadbutt --daemon`) gets a
+SIGHUP to reload the config after it gets rewritten.
 """
 from __future__ import unicode_literals
 
 import argparse
+import io
+import json
 import os.path
+import signal
 import sys
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
-import boto
-import boto.dynamodb
-import boto.ec2
-import boto.ec2.elb
-import boto.ec2.cloudwatch
-import boto.rds
-import boto.elasticache
-import boto.ec2.autoscale
-import boto.kinesis
-import boto.sqs
-import boto.redshift
 import jinja2
+import yaml
 
-from leadbutt import __version__
+from leadbutt import __version__, default_pool, get_queries, iter_config_stream, load_plugin
 
 # DEFAULT_NAMESPACE = 'ec2'  # TODO
 DEFAULT_REGION = 'us-east-1'
 
+# compiled templates are kept here between runs; set PLUMBUM_CACHE_DIR or
+# pass --cache-dir to move it, or an empty --cache-dir to turn it off
+DEFAULT_CACHE_DIR = os.environ.get('PLUMBUM_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'plumbum'))
+
+# jinja2 environments by (template directory, cache directory), so templates
+# only get compiled once per process
+_jinja_environments = {}
+
+# how long fetched tags are reused, mostly for --watch
+TAG_CACHE_TTL = 3600
+# the most load balancers one ELB DescribeTags call takes
+ELB_TAG_BATCH_SIZE = 20
+# how many tag requests to make at once where there is no batch API
+TAG_FETCH_THREADS = 10
+
 
 class CliArgsException(Exception):
     pass
@@ -78,13 +121,180 @@ def filter_key(filter_args):
     return filter_instance
 
 
+class TagCache(object):
+    """Tags by (namespace, region, resource id), reused for `ttl` seconds."""
+
+    def __init__(self, ttl=TAG_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, now=None):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or entry[0] + self.ttl <= (now or time.time()):
+            return None
+        return entry[1]
+
+    def put(self, key, tags, now=None):
+        with self.lock:
+            self.entries[key] = (now or time.time(), tags)
+
+
+# shared by every listing in the process, so --watch and --manifest reuse tags
+default_tag_cache = TagCache()
+
+
+class TagLoader(object):
+    """Fetches the tags for all the resources in one listing, once."""
+
+    def __init__(self, namespace, region, resource_ids, cache=None):
+        self.namespace = namespace
+        self.region = region
+        self.resource_ids = resource_ids
+        self.cache = cache or default_tag_cache
+        self.tags = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.tags is None:
+                self.tags = get_tags(self.namespace, self.region, self.resource_ids, self.cache)
+        return self.tags
+
+
+class LazyTags(Mapping):
+    """The tags of one resource, only fetched when something looks at them."""
+
+    def __init__(self, loader, resource_id):
+        self.loader = loader
+        self.resource_id = resource_id
+
+    def _tags(self):
+        return self.loader.load().get(self.resource_id, {})
+
+    def __getitem__(self, key):
+        return self._tags()[key]
+
+    def __iter__(self):
+        return iter(self._tags())
+
+    def __len__(self):
+        return len(self._tags())
+
+    def __repr__(self):
+        return repr(self._tags())
+
+
+def attach_tags(namespace, region, resources, get_id):
+    """Give each of `resources` a `tags` attribute, fetched together the first time it is used."""
+    loader = TagLoader(namespace, region, [get_id(resource) for resource in resources])
+    for resource in resources:
+        resource.tags = LazyTags(loader, get_id(resource))
+    return resources
+
+
+def get_tags(namespace, region, resource_ids, cache=None):
+    """Get the tags for `resource_ids` as a dict of id to tags, from `cache` where it can."""
+    cache = cache or default_tag_cache
+    tags = {}
+    missing = []
+    for resource_id in resource_ids:
+        cached = cache.get((namespace, region, resource_id))
+        if cached is None:
+            missing.append(resource_id)
+        else:
+            tags[resource_id] = cached
+    if missing:
+        fetched = tag_fetchers[namespace](region, missing)
+        for resource_id in missing:
+            tags[resource_id] = fetched.get(resource_id, {})
+            cache.put((namespace, region, resource_id), tags[resource_id])
+    return tags
+
+
+def query_xml(conn, action, params):
+    """
+    Make a query API request boto has no method for, returning the response
+    without XML namespaces.
+    """
+    from xml.etree import ElementTree
+
+    response = conn.make_request(action, params)
+    body = response.read()
+    if response.status != 200:
+        raise conn.ResponseError(response.status, response.reason, body)
+    root = ElementTree.fromstring(body)
+    for element in root.iter():
+        element.tag = element.tag.rsplit('}', 1)[-1]
+    return root
+
+
+def fetch_elb_tags(region, names):
+    """Fetch the tags for the load balancers `names`, in batches."""
+    tags = {}
+    with default_pool.connection('boto.ec2.elb:connect_to_region', region) as conn:
+        for start in range(0, len(names), ELB_TAG_BATCH_SIZE):
+            params = {}
+            conn.build_list_params(params, names[start:start + ELB_TAG_BATCH_SIZE],
+                                   'LoadBalancerNames.member')
+            response = query_xml(conn, 'DescribeTags', params)
+            for description in response.findall('.//TagDescriptions/member'):
+                tags[description.findtext('LoadBalancerName')] = dict(
+                    (tag.findtext('Key'), tag.findtext('Value') or '')
+                    for tag in description.findall('Tags/member'))
+    return tags
+
+
+def get_partition(region):
+    if region.startswith('cn-'):
+        return 'aws-cn'
+    if region.startswith('us-gov-'):
+        return 'aws-us-gov'
+    return 'aws'
+
+
+def fetch_rds_tags(region, instance_ids):
+    """
+    Fetch the tags for the RDS instances `instance_ids`, a few at a time as
+    RDS has no batch call.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    with default_pool.connection('boto.sts:connect_to_region', region) as conn:
+        account = query_xml(conn, 'GetCallerIdentity', {}).findtext('.//Account')
+
+    def fetch(instance_id):
+        arn = 'arn:{0}:rds:{1}:{2}:db:{3}'.format(get_partition(region), region, account,
+                                                  instance_id)
+        with default_pool.connection('boto.rds2:connect_to_region', region) as conn:
+            response = conn.list_tags_for_resource(arn)
+        tag_list = response['ListTagsForResourceResponse']['ListTagsForResourceResult']['TagList']
+        return instance_id, dict((tag['Key'], tag['Value']) for tag in tag_list)
+
+    pool = ThreadPool(min(TAG_FETCH_THREADS, len(instance_ids)))
+    try:
+        return dict(pool.map(fetch, instance_ids))
+    finally:
+        pool.close()
+
+
+# Tag fetchers for namespaces whose listings come without tags; each is called
+# with a region and a list of resource ids, and returns a dict of id to tags.
+tag_fetchers = {
+    'elb': fetch_elb_tags,
+    'rds': fetch_rds_tags,
+}
+
+
 def lookup(instances, filter_by=None):
     if filter_by is not None:
         return list(filter(filter_key(filter_by), instances))
     return instances
 
 
-def interpret_options(args=sys.argv[1:]):
+def parse_args(args=sys.argv[1:]):
+    import boto.ec2
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', action='version', version=__version__)
@@ -93,29 +303,75 @@ def interpret_options(args=sys.argv[1:]):
                         default=DEFAULT_REGION)
     parser.add_argument("-f", "--filter", action='append', default=[],
                         help="filter to apply to AWS objects in key=value form, can be used multiple times")
-    parser.add_argument('--token', action='append', help='a key=value pair to use when populating templates')
-    parser.add_argument("template", type=str, help="the template to interpret")
-    parser.add_argument("namespace", type=str, help="AWS namespace")
+    parser.add_argument('--token', action='append',
+                        help='a key=value pair to use when populating templates')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='where to keep compiled templates between runs, empty to not keep '
+                             'them')
+    parser.add_argument('--manifest',
+                        help='a YAML list of jobs to render instead of a single template')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='keep polling for resources, rewriting --output when its metrics '
+                             'change')
+    parser.add_argument('--output', help='file to write the config to, instead of stdout')
+    parser.add_argument('--pid-file',
+                        help='send the process in this pid file a SIGHUP when --output changes')
+    parser.add_argument('--format', choices=['yaml', 'jsonl'], default='yaml',
+                        help='output the config as rendered, or as one JSON object per line for '
+                             'leadbutt --stream')
+    parser.add_argument('--tag-ttl', type=float, default=TAG_CACHE_TTL, metavar='SECONDS',
+                        help='how long to reuse the tags fetched for ELB and RDS resources')
+    parser.add_argument("template", type=str, nargs='?', help="the template to interpret")
+    parser.add_argument("namespace", type=str, nargs='?', help="AWS namespace")
 
     args = parser.parse_args(args=args)
+    if args.manifest is None and args.namespace is None:
+        parser.error('a template and namespace are required unless using --manifest')
+    if args.watch is not None and args.output is None:
+        parser.error('--watch needs an --output file to keep up to date')
+    return args
+
+
+def normalize_namespace(namespace):
+    """Support 'ec2' (human friendly) and 'AWS/EC2' (how CloudWatch natively calls these things)"""
+    return namespace.rsplit('/', 2)[-1].lower()
+
+
+def interpret_options(args=sys.argv[1:]):
+    if isinstance(args, list):
+        args = parse_args(args)
 
     # filters are passed in as list of key=values pairs, we need a dictionary to pass to lookup()
     filters = dict([x.split('=', 1) for x in args.filter])
 
-    # Support 'ec2' (human friendly) and 'AWS/EC2' (how CloudWatch natively calls these things)
     if args.namespace is not None:  # Just making test pass, argparse will catch this missing.
-        namespace = args.namespace.rsplit('/', 2)[-1].lower()
+        namespace = normalize_namespace(args.namespace)
     else:
         namespace = None
     return args.template, namespace, args.region, filters, args.token
 
 
-def get_jinja_template(template_file):
-    """Given a file path, return a jinja2 object on which to call .render()"""
+def get_jinja_template(template_file, cache_dir=None):
+    """
+    Given a file path, return a jinja2 object on which to call .render()
+
+    If `cache_dir` is set, compiled templates are kept there so later runs
+    can skip compiling them.
+    """
     fs_path = os.path.abspath(os.path.dirname(template_file))
-    loader = jinja2.FileSystemLoader(fs_path)
-    jinja2_env = jinja2.Environment(loader=loader)
-    return jinja2_env.get_template(os.path.basename(template_file))
+    key = (fs_path, cache_dir)
+    if key not in _jinja_environments:
+        loader = jinja2.FileSystemLoader(fs_path)
+        bytecode_cache = None
+        if cache_dir:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+            except OSError:
+                pass  # an unwritable cache just means compiling every time
+        _jinja_environments[key] = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
+    return _jinja_environments[key].get_template(os.path.basename(template_file))
 
 
 def get_template_tokens(base_tokens={}, cli_tokens=[]):
@@ -134,100 +390,106 @@ def get_template_tokens(base_tokens={}, cli_tokens=[]):
 
 def list_billing(region, filter_by_kwargs):
     """List available billing metrics"""
-    conn = boto.ec2.cloudwatch.connect_to_region(region)
-    metrics = conn.list_metrics(metric_name='EstimatedCharges')
-    # Filtering is based on metric Dimensions.  Only really valuable one is
-    # ServiceName.
-    if filter_by_kwargs:
-        filter_key = filter_by_kwargs.keys()[0]
-        filter_value = filter_by_kwargs.values()[0]
-        if filter_value:
-            filtered_metrics = [x for x in metrics if x.dimensions.get(filter_key) and x.dimensions.get(filter_key)[0] == filter_value]
+    with default_pool.connection('boto.ec2.cloudwatch:connect_to_region', region) as conn:
+        metrics = conn.list_metrics(metric_name='EstimatedCharges')
+        # Filtering is based on metric Dimensions.  Only really valuable one is
+        # ServiceName.
+        if filter_by_kwargs:
+            filter_key = filter_by_kwargs.keys()[0]
+            filter_value = filter_by_kwargs.values()[0]
+            if filter_value:
+                filtered_metrics = [x for x in metrics if x.dimensions.get(filter_key) and
+                                    x.dimensions.get(filter_key)[0] == filter_value]
+            else:
+                # ServiceName=''
+                filtered_metrics = [x for x in metrics if not x.dimensions.get(filter_key)]
         else:
-            # ServiceName=''
-            filtered_metrics = [x for x in metrics if not x.dimensions.get(filter_key)]
-    else:
-        filtered_metrics = metrics
-    return filtered_metrics
+            filtered_metrics = metrics
+        return filtered_metrics
 
 
 def list_ec2(region, filter_by_kwargs):
     """List running ec2 instances."""
-    conn = boto.ec2.connect_to_region(region)
-    instances = conn.get_only_instances()
-    return lookup(instances, filter_by=filter_by_kwargs)
+    with default_pool.connection('boto.ec2:connect_to_region', region) as conn:
+        instances = conn.get_only_instances()
+        return lookup(instances, filter_by=filter_by_kwargs)
 
 
 def list_elb(region, filter_by_kwargs):
     """List all load balancers."""
-    conn = boto.ec2.elb.connect_to_region(region)
-    instances = conn.get_all_load_balancers()
+    with default_pool.connection('boto.ec2.elb:connect_to_region', region) as conn:
+        instances = conn.get_all_load_balancers()
+    attach_tags('elb', region, instances, lambda instance: instance.name)
     return lookup(instances, filter_by=filter_by_kwargs)
 
 
 def list_rds(region, filter_by_kwargs):
     """List all RDS thingys."""
-    conn = boto.rds.connect_to_region(region)
-    instances = conn.get_all_dbinstances()
+    with default_pool.connection('boto.rds:connect_to_region', region) as conn:
+        instances = conn.get_all_dbinstances()
+    attach_tags('rds', region, instances, lambda instance: instance.id)
     return lookup(instances, filter_by=filter_by_kwargs)
 
 
 def list_elasticache(region, filter_by_kwargs):
     """List all ElastiCache Clusters."""
-    conn = boto.elasticache.connect_to_region(region)
-    req = conn.describe_cache_clusters()
-    data = req["DescribeCacheClustersResponse"]["DescribeCacheClustersResult"]["CacheClusters"]
-    if filter_by_kwargs:
-        clusters = [x['CacheClusterId'] for x in data if x[filter_by_kwargs.keys()[0]] == filter_by_kwargs.values()[0]]
-    else:
-        clusters = [x['CacheClusterId'] for x in data]
-    return clusters
+    with default_pool.connection('boto.elasticache:connect_to_region', region) as conn:
+        req = conn.describe_cache_clusters()
+        data = req["DescribeCacheClustersResponse"]["DescribeCacheClustersResult"]["CacheClusters"]
+        if filter_by_kwargs:
+            clusters = [x['CacheClusterId'] for x in data
+                        if x[filter_by_kwargs.keys()[0]] == filter_by_kwargs.values()[0]]
+        else:
+            clusters = [x['CacheClusterId'] for x in data]
+        return clusters
 
 
 def list_autoscaling_group(region, filter_by_kwargs):
     """List all Auto Scaling Groups."""
-    conn = boto.ec2.autoscale.connect_to_region(region)
-    groups = conn.get_all_groups()
-    return lookup(groups, filter_by=filter_by_kwargs)
+    with default_pool.connection('boto.ec2.autoscale:connect_to_region', region) as conn:
+        groups = conn.get_all_groups()
+        return lookup(groups, filter_by=filter_by_kwargs)
 
 
 def list_sqs(region, filter_by_kwargs):
     """List all SQS Queues."""
-    conn = boto.sqs.connect_to_region(region)
-    queues = conn.get_all_queues()
-    return lookup(queues, filter_by=filter_by_kwargs)
+    with default_pool.connection('boto.sqs:connect_to_region', region) as conn:
+        queues = conn.get_all_queues()
+        return lookup(queues, filter_by=filter_by_kwargs)
 
 
 def list_kinesis_applications(region, filter_by_kwargs):
     """List all the kinesis applications along with the shards for each stream"""
-    conn = boto.kinesis.connect_to_region(region)
-    streams = conn.list_streams()['StreamNames']
-    kinesis_streams = {}
-    for stream_name in streams:
-        shard_ids = []
-        shards = conn.describe_stream(stream_name)['StreamDescription']['Shards']
-        for shard in shards:
-            shard_ids.append(shard['ShardId'])
-        kinesis_streams[stream_name] = shard_ids
-    return kinesis_streams
+    with default_pool.connection('boto.kinesis:connect_to_region', region) as conn:
+        streams = conn.list_streams()['StreamNames']
+        kinesis_streams = {}
+        for stream_name in streams:
+            shard_ids = []
+            shards = conn.describe_stream(stream_name)['StreamDescription']['Shards']
+            for shard in shards:
+                shard_ids.append(shard['ShardId'])
+            kinesis_streams[stream_name] = shard_ids
+        return kinesis_streams
 
 
 def list_dynamodb(region, filter_by_kwargs):
     """List all DynamoDB tables."""
-    conn = boto.dynamodb.connect_to_region(region)
-    tables = conn.list_tables()
-    return lookup(tables, filter_by=filter_by_kwargs)
+    with default_pool.connection('boto.dynamodb:connect_to_region', region) as conn:
+        tables = conn.list_tables()
+        return lookup(tables, filter_by=filter_by_kwargs)
 
 
 def list_redshift(region, filter_by_kwargs):
     """ list all redshift clusters."""
-    conn = boto.redshift.connect_to_region(region)
-    response = conn.describe_clusters()['DescribeClustersResponse']
-    result = response['DescribeClustersResult']
-    clusters = result['Clusters']
-    return lookup(clusters, filter_by=filter_by_kwargs)
+    with default_pool.connection('boto.redshift:connect_to_region', region) as conn:
+        response = conn.describe_clusters()['DescribeClustersResponse']
+        result = response['DescribeClustersResult']
+        clusters = result['Clusters']
+        return lookup(clusters, filter_by=filter_by_kwargs)
 
 
+# Namespace listers; each is called with a region and a dict of filters. Other
+# packages can add namespaces by registering a `plumbum.listers` entry point.
 list_resources = {
     'ec2': list_ec2,
     'elb': list_elb,
@@ -242,32 +504,199 @@ list_resources = {
 }
 
 
-def main():
+def get_lister(namespace):
+    """Get the lister for `namespace`, loading third party listers on demand."""
+    return load_plugin('plumbum.listers', namespace, list_resources)
+
 
-    template_file, namespace, region, filters, cli_tokens = interpret_options()
+def get_resources(namespace, region, filters, inventory=None):
+    """
+    List the resources in `namespace`, reusing what's in `inventory`.
+
+    `inventory` is a dict shared between calls, keyed by namespace, region
+    and filters.
+    """
+    if inventory is None:
+        inventory = {}
+    key = (namespace, region, tuple(sorted(filters.items())))
+    if key not in inventory:
+        inventory[key] = get_lister(namespace)(region, filters)
+    return inventory[key]
 
+
+def render(template_file, namespace, region, filters, cli_tokens, cache_dir=None, inventory=None):
+    """Render `template_file` with the resources found in `namespace`."""
     # get the template first so this can fail before making a network request
-    jinja_template = get_jinja_template(template_file)
+    jinja_template = get_jinja_template(template_file, cache_dir)
 
     # should I be using ARNs?
     try:
-        resources = list_resources[namespace](region, filters)
+        get_lister(namespace)
     except KeyError:
         print('ERROR: AWS namespace "{}" not supported or does not exist'
               .format(namespace))
         sys.exit(1)
+    resources = get_resources(namespace, region, filters, inventory)
 
     base_tokens = {
         'filters': filters,
         'region': region,  # Use for Auth config section if needed
         'resources': resources,
     }
+    return jinja_template.render(get_template_tokens(base_tokens=base_tokens,
+                                                     cli_tokens=cli_tokens))
+
+
+def render_manifest(manifest_file, cache_dir=None):
+    """Render every job in `manifest_file`, sharing templates and inventory between them."""
+    with open(manifest_file) as fp:
+        jobs = yaml.safe_load(fp)
+    inventory = {}
+    for job in jobs:
+        namespace = normalize_namespace(job['namespace'])
+        tokens = ['{0}={1}'.format(key, value) for key, value in job.get('tokens', {}).items()]
+        output = format_config(render(
+            job['template'], namespace, job.get('region', DEFAULT_REGION),
+            job.get('filters', {}), tokens, cache_dir=cache_dir, inventory=inventory,
+        ), job.get('format', 'yaml'))
+        if job.get('output'):
+            with open(job['output'], 'w') as fp:
+                fp.write(output + '\n')
+        else:
+            print(output)
+
 
-    print(
-        jinja_template.render(
-            get_template_tokens(base_tokens=base_tokens, cli_tokens=cli_tokens)
-        )
-    )
+def to_json_lines(config_text):
+    """
+    Convert a rendered config to one JSON object per line: first everything
+    but the Metrics, then each Metrics entry. leadbutt --stream can start
+    fetching these before it has read the whole config.
+    """
+    config = yaml.safe_load(config_text) or {}
+    lines = []
+    sections = dict((key, value) for key, value in config.items() if key != 'Metrics')
+    if sections:
+        lines.append(json.dumps(sections, sort_keys=True))
+    lines.extend(json.dumps(metric, sort_keys=True) for metric in config.get('Metrics') or [])
+    return '\n'.join(lines)
+
+
+def format_config(config_text, output_format):
+    if output_format == 'jsonl':
+        return to_json_lines(config_text)
+    return config_text
+
+
+def parse_config(config_text):
+    """Parse a config in any format leadbutt reads."""
+    if isinstance(config_text, bytes):
+        config_text = config_text.decode('utf-8')  # read from a file on Python 2
+    config = {}
+    for section, value in iter_config_stream(io.StringIO(config_text)):
+        if section == 'Metrics':
+            config.setdefault('Metrics', []).append(value)
+        else:
+            config[section] = value
+    return config
+
+
+def metric_set(config_text):
+    """
+    Get the set of queries in a rendered config, to see if it changed.
+
+    Each query is a JSON string of its key and metric; everything in the
+    config other than its Metrics counts as one more member of the set.
+    """
+    config = parse_config(config_text)
+    members = set(json.dumps([key, metric], sort_keys=True)
+                  for key, (metric, options) in get_queries(config, None).items())
+    members.add(json.dumps(dict((key, value) for key, value in config.items() if key != 'Metrics'),
+                           sort_keys=True))
+    return members
+
+
+def write_atomically(path, text):
+    """
+    Replace `path` with `text` so a reader never sees half a file. The file
+    keeps its mode, or gets the usual one for a new file.
+    """
+    import tempfile
+
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.plumbum')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(text)
+    os.chmod(tmp_path, mode)
+    os.rename(tmp_path, path)
+
+
+def signal_reload(pid_file):
+    """Ask the process in `pid_file` to reload its config."""
+    try:
+        with open(pid_file) as fp:
+            os.kill(int(fp.read().strip()), signal.SIGHUP)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('WARNING: could not signal the process in {0}: {1}\n'.format(pid_file, e))
+
+
+def watch(template_file, namespace, region, filters, cli_tokens, output, interval,
+          pid_file=None, cache_dir=None, polls=None, output_format='yaml'):
+    """
+    Poll for resources every `interval` seconds, rewriting `output` whenever
+    the set of metrics in it changes. Stops after `polls` polls if it is set.
+    A poll that fails leaves `output` as it was until the next one.
+    """
+    previous = None
+    if os.path.exists(output):
+        with open(output) as fp:
+            previous = metric_set(fp.read())
+    poll = 0
+    while polls is None or poll < polls:
+        if poll:
+            time.sleep(interval)
+        poll += 1
+        try:
+            rendered = render(template_file, namespace, region, filters, cli_tokens,
+                              cache_dir=cache_dir)
+            current = metric_set(rendered)
+        except Exception as e:  # AWS, network and template errors alike; try again next poll
+            sys.stderr.write('ERROR: could not render {0}: {1}\n'.format(template_file, e))
+            continue
+        if current == previous:
+            continue
+        write_atomically(output, format_config(rendered, output_format) + '\n')
+        if previous is not None:
+            sys.stderr.write('{0}: {1} queries added, {2} removed\n'.format(
+                output, len(current - previous), len(previous - current)))
+        previous = current
+        if pid_file:
+            signal_reload(pid_file)
+
+
+def main():
+    args = parse_args()
+    cache_dir = args.cache_dir or None
+    default_tag_cache.ttl = args.tag_ttl
+    if args.manifest is not None:
+        render_manifest(args.manifest, cache_dir)
+        return
+
+    template_file, namespace, region, filters, cli_tokens = interpret_options(args)
+    if args.watch is not None:
+        watch(template_file, namespace, region, filters, cli_tokens, args.output, args.watch,
+              pid_file=args.pid_file, cache_dir=cache_dir, output_format=args.format)
+        return
+    rendered = render(template_file, namespace, region, filters, cli_tokens, cache_dir=cache_dir)
+    output = format_config(rendered, args.format)
+    if args.output is not None:
+        write_atomically(args.output, output + '\n')
+    else:
+        print(output)
 
 
 if __name__ == '__main__':
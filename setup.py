@@ -8,7 +8,7 @@ setup(
     author='Chris Chang',
     author_email='c@crccheck.com',
     url='https://github.com/crccheck/cloudwatch-to-graphite',
-    py_modules=['leadbutt', 'plumbum', 'plumblead'],
+    py_modules=['leadbutt', 'leadbutt_async', 'plumbum', 'plumblead'],
     entry_points={
         'console_scripts': [
             'leadbutt = leadbutt:main',
@@ -23,6 +23,9 @@ setup(
         'Jinja2',
         'retrying',
     ],
+    extras_require={
+        'derived': ['numpy'],
+    },
     license='Apache License, Version 2.0',
     long_description=open('README.rst').read(),
     classifiers=[
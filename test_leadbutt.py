@@ -8,10 +8,29 @@ from __future__ import unicode_literals
 
 from subprocess import call
 import datetime
+import json
 import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
 
 import leadbutt
 
@@ -47,6 +66,75 @@ class get_configTest(unittest.TestCase):
         self.assertTrue(mock_stderr.write.called)
 
 
+class iter_configTest(unittest.TestCase):
+    class EndlessConfig(object):
+        """A config with Auth, then an endless list of Metrics."""
+        def __init__(self, head, entry):
+            self.head = head
+            self.entry = entry
+            self.count = 0
+
+        def readline(self):
+            return self.read()
+
+        def read(self, size=-1):
+            if self.count == 0:
+                self.count += 1
+                return self.head
+            self.count += 1
+            return self.entry.format(self.count)
+
+        def __iter__(self):
+            while True:
+                yield self.read()
+
+    def test_yaml_matches_get_config(self):
+        config = leadbutt.get_config('config.yaml.example')
+        with open('config.yaml.example') as fp:
+            items = list(leadbutt.iter_config_stream(fp))
+        self.assertEqual([value for section, value in items if section == 'Metrics'],
+                         config['Metrics'])
+        self.assertIn(('Auth', config['Auth']), items)
+        self.assertIn(('Options', config['Options']), items)
+
+    def test_yaml_metrics_come_out_before_the_end(self):
+        config = self.EndlessConfig(
+            'Auth:\n  region: us-west-2\nMetrics:\n',
+            '- {{Namespace: AWS/EC2, MetricName: CPUUtilization, '
+            'Dimensions: {{InstanceId: i-{0}}}}}\n')
+        items = leadbutt.iter_config_stream(config)
+        self.assertEqual(next(items), ('Auth', {'region': 'us-west-2'}))
+        for x in range(100):
+            section, metric = next(items)
+        self.assertEqual(section, 'Metrics')
+        self.assertLess(config.count, 1000)
+
+    def test_line_delimited(self):
+        config = self.EndlessConfig(
+            '{"Auth": {"region": "us-west-2"}, "Options": {"Count": 3}}\n',
+            '{{"Namespace": "AWS/EC2", "MetricName": "CPUUtilization", '
+            '"Dimensions": {{"InstanceId": "i-{0}"}}}}\n')
+        items = leadbutt.iter_config_stream(config)
+        self.assertEqual(sorted([next(items), next(items)]),
+                         [('Auth', {'region': 'us-west-2'}), ('Options', {'Count': 3})])
+        self.assertEqual(next(items)[1]['Dimensions'], {'InstanceId': 'i-2'})
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.iter_config')
+    def test_run_stream(self, mock_iter_config, mock_connect, mock_sleep):
+        mock_iter_config.return_value = iter([
+            ('Auth', {'region': 'us-west-2'}),
+            ('Metrics', {'Namespace': 'AWS/EC2', 'MetricName': ['CPUUtilization', 'NetworkIn'],
+                         'Statistics': 'Sum', 'Dimensions': {'InstanceId': 'i-r0b0t'}}),
+        ])
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        self.assertTrue(leadbutt.leadbutt('dummy_config_file', {'Count': 1, 'Period': 5},
+                                          stream=True))
+        mock_connect.assert_called_once_with('us-west-2', debug=0)
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 2)
+
+
 class get_optionsTest(unittest.TestCase):
     def test_get_options_returns_right_option(self):
         # only have the defaults
@@ -168,6 +256,1018 @@ class leadbuttTest(unittest.TestCase):
         self.assertEqual(kwargs['aws_secret_access_key'], 'bar')
 
 
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_drain_resumes_after_restart(self):
+        spool = leadbutt.Spool(self.directory, segment_bytes=20)
+        for x in range(10):
+            spool.append(['line.{0} 1 2\n'.format(x)])
+        drained = []
+
+        def flaky_write(lines):
+            if len(drained) == 3:
+                raise IOError('sink went away')
+            drained.extend(lines)
+        with self.assertRaises(IOError):
+            spool.drain(flaky_write, batch_size=1)
+
+        spool = leadbutt.Spool(self.directory)
+        spool.drain(drained.extend)
+        self.assertEqual(drained, ['line.{0} 1 2\n'.format(x) for x in range(10)])
+        self.assertFalse(spool.pending())
+
+    def test_oldest_segments_are_dropped(self):
+        spool = leadbutt.Spool(self.directory, max_bytes=50, segment_bytes=10)
+        for x in range(20):
+            spool.append(['line.{0:02d} 1 2\n'.format(x)])
+        drained = []
+        spool.drain(drained.extend)
+        self.assertLess(len(drained), 20)
+        self.assertEqual(drained[-1], 'line.19 1 2\n')
+
+    def test_spooling_output_spools_while_sink_is_down(self):
+        sink = mock.Mock(side_effect=IOError('broken pipe'))
+        output = leadbutt.SpoolingOutput(sink, leadbutt.Spool(self.directory), drain_rate=None)
+        output.write('a 1 2\n')
+        output.flush()
+        output.write('b 1 2\n')
+        output.flush()
+        self.assertEqual(sink.call_count, 1)
+
+        sink.side_effect = None
+        output.retry_at = 0
+        output.write('c 1 2\n')
+        output.flush()
+        lines = [line for call in sink.call_args_list[1:] for line in call[0][0]]
+        self.assertEqual(lines, ['a 1 2\n', 'b 1 2\n', 'c 1 2\n'])
+
+    @mock.patch('leadbutt.time.time')
+    def test_spooling_output_drains_a_slice_per_flush(self, mock_time):
+        mock_time.return_value = 1000.0
+        spool = leadbutt.Spool(self.directory)
+        for x in range(10):
+            spool.append(['line.{0} 1 2\n'.format(x)])
+        sink = mock.Mock()
+        output = leadbutt.SpoolingOutput(sink, spool, drain_rate=4)
+        output.flush()
+        self.assertEqual(sum(len(call[0][0]) for call in sink.call_args_list), 4)
+        # new lines wait behind the spool
+        output.write('new 1 2\n')
+        mock_time.return_value += 0.5
+        output.flush()
+        self.assertEqual(sum(len(call[0][0]) for call in sink.call_args_list), 6)
+        mock_time.return_value += 10
+        output.flush()
+        output.flush()
+        mock_time.return_value += 1
+        output.flush()
+        lines = [line for call in sink.call_args_list for line in call[0][0]]
+        self.assertEqual(lines, ['line.{0} 1 2\n'.format(x) for x in range(10)] + ['new 1 2\n'])
+        self.assertFalse(spool.pending())
+
+
+class SinkTest(unittest.TestCase):
+    def test_get_sink(self):
+        self.assertIsInstance(leadbutt.get_sink('stdout'), leadbutt.StdoutSink)
+        sink = leadbutt.get_sink('graphite://graphite.local?batch=10')
+        self.assertEqual(sink.address, ('graphite.local', 2003))
+        sink = leadbutt.get_sink('influxdb://influx.local:9999?db=metrics&policy=drop')
+        self.assertEqual(sink.url, 'http://influx.local:9999/write?db=metrics&precision=s')
+        with self.assertRaises(ValueError):
+            leadbutt.get_sink('carrier-pigeon://coop')
+
+    def test_formats(self):
+        line = 'cloudwatch.aws.foo.x.requestcount.sum.count 1337.0 1420070400\n'
+        self.assertEqual(leadbutt.StatsdSink('localhost').format(line),
+                         'cloudwatch.aws.foo.x.requestcount.sum.count:1337.0|g\n')
+        self.assertEqual(leadbutt.InfluxDBSink('http://localhost').format(line),
+                         'cloudwatch.aws.foo.x.requestcount.sum.count value=1337.0 1420070400\n')
+
+    def test_serve_sink_serves_latest_values(self):
+        sink = leadbutt.ServeSink('127.0.0.1', 0)
+        self.addCleanup(sink.close)
+        sink.send(['cloudwatch.aws.ec2.i-r0b0t.cpuutilization.average.percent 12.5 1420070460\n',
+                   'cloudwatch.aws.ec2.i-r0b0t.cpuutilization.average.percent 99.0 1420070400\n',
+                   'cloudwatch.aws.ec2.i-r0b0t.networkin.sum.bytes 1024.0 1420070400\n'])
+        self.assertEqual(len(sink.store), 2)
+        url = 'http://127.0.0.1:{0}'.format(sink.server.server_address[1])
+        body = urlopen(url + '/metrics').read().decode('utf-8')
+        self.assertIn(
+            'cloudwatch_aws_ec2_i_r0b0t_cpuutilization_average_percent 12.5 1420070460000\n', body)
+        latest = json.loads(urlopen(url + '/metrics.json').read().decode('utf-8'))
+        self.assertEqual(latest['cloudwatch.aws.ec2.i-r0b0t.networkin.sum.bytes'],
+                         [1024.0, 1420070400])
+
+    def test_fan_out_sends_everything_to_every_sink(self):
+        sinks = [mock.Mock(), mock.Mock()]
+        fan_out = leadbutt.FanOut([leadbutt.SinkWorker(sink, batch_size=2) for sink in sinks])
+        for x in range(5):
+            fan_out.write('a {0} 1\n'.format(x))
+        fan_out.close()
+        for sink in sinks:
+            lines = [line for call in sink.send.call_args_list for line in call[0][0]]
+            self.assertEqual(len(lines), 5)
+        self.assertEqual(fan_out.stats()[sinks[0].name]['sent'], 5)
+
+    def test_drop_policy_counts_drops(self):
+        sink = mock.Mock()
+        worker = leadbutt.SinkWorker(sink, policy='drop', queue_size=1)
+        with mock.patch.object(worker.queue, 'put_nowait', side_effect=leadbutt.queue.Full):
+            worker.write('a 1 1\n')
+        worker.close()
+        self.assertEqual(worker.stats()['dropped'], 1)
+        self.assertEqual(worker.stats()['sent'], 0)
+
+    def test_malformed_lines_do_not_stop_the_worker(self):
+        sink = leadbutt.StatsdSink('127.0.0.1', 9)
+        sink.sock.close()
+        sink.sock = mock.Mock()
+        worker = leadbutt.SinkWorker(sink, batch_size=1)
+        with mock.patch('sys.stderr') as mock_stderr:
+            worker.write('cloudwatch.aws.ec2.web asg.cpuutilization 12.5 1420070400\n')
+            worker.write('cloudwatch.aws.ec2.web.cpuutilization 12.5 1420070400\n')
+            worker.close()
+        self.assertEqual(worker.stats()['sent'], 1)
+        self.assertEqual(worker.stats()['dropped'], 1)
+        self.assertEqual(worker.stats()['errors'], 1)
+        self.assertEqual(sink.sock.sendto.call_count, 1)
+        self.assertTrue(mock_stderr.write.called)
+
+    def test_spooled_lines_are_not_counted_as_sent(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        sink = mock.Mock()
+        sink.send.side_effect = IOError('connection refused')
+        worker = leadbutt.SinkWorker(sink, spool=leadbutt.Spool(directory))
+        worker.send(['a 1 1\n', 'b 1 1\n'])
+        self.assertEqual(worker.stats()['sent'], 0)
+        self.assertEqual(worker.stats()['errors'], 1)
+        sink.send.side_effect = None
+        worker.output.retry_at = 0
+        worker.send(['c 1 1\n'])
+        worker.close()
+        self.assertEqual(worker.stats()['sent'], 3)
+
+
+class AggregatorTest(unittest.TestCase):
+    rollup = {
+        'Namespace': 'AWS/Kinesis',
+        'MetricName': 'IncomingBytes',
+        'Statistic': 'Sum',
+        'GroupBy': ['StreamName'],
+        'Functions': ['sum', 'max', 'count'],
+        'DropMembers': True,
+    }
+
+    def shard_metric(self, stream, shard):
+        return {
+            'Namespace': 'AWS/Kinesis',
+            'MetricName': 'IncomingBytes',
+            'Statistics': 'Sum',
+            'Dimensions': {'StreamName': stream, 'ShardId': shard},
+        }
+
+    def test_rolls_up_by_group(self):
+        timestamp = datetime.datetime(2015, 1, 1)
+        aggregator = leadbutt.Aggregator([self.rollup])
+        for stream, shard, value in [('a', '1', 1.0), ('a', '2', 2.0), ('b', '1', 5.0)]:
+            drop = aggregator.observe([{'Timestamp': timestamp, 'Unit': 'Bytes', 'Sum': value}],
+                                      self.shard_metric(stream, shard))
+            self.assertTrue(drop)
+        # metrics that are not rolled up are left alone
+        self.assertFalse(aggregator.observe(
+            [], dict(self.shard_metric('a', '1'), Namespace='AWS/EC2')))
+        lines = []
+        aggregator.output(lines.append)
+        self.assertEqual(lines, [
+            'cloudwatch.aws.kinesis.a.incomingbytes.sum.sum 3.0 1420070400\n',
+            'cloudwatch.aws.kinesis.a.incomingbytes.sum.max 2.0 1420070400\n',
+            'cloudwatch.aws.kinesis.a.incomingbytes.sum.count 2 1420070400\n',
+            'cloudwatch.aws.kinesis.b.incomingbytes.sum.sum 5.0 1420070400\n',
+            'cloudwatch.aws.kinesis.b.incomingbytes.sum.max 5.0 1420070400\n',
+            'cloudwatch.aws.kinesis.b.incomingbytes.sum.count 1 1420070400\n',
+        ])
+
+    def test_rolls_up_everything_without_group_by(self):
+        timestamp = datetime.datetime(2015, 1, 1)
+        rollup = dict(self.rollup, GroupBy=[], Functions=['avg'],
+                      Formatter='kinesis.%(group)s.%(function)s')
+        aggregator = leadbutt.Aggregator([rollup])
+        for stream, value in [('a', 1.0), ('b', 2.0)]:
+            aggregator.observe([{'Timestamp': timestamp, 'Unit': 'Bytes', 'Sum': value}],
+                               self.shard_metric(stream, '1'))
+        lines = []
+        aggregator.output(lines.append)
+        self.assertEqual(lines, ['kinesis.all.avg 1.5 1420070400\n'])
+
+    def test_rolls_up_each_metric_on_its_own(self):
+        timestamp = datetime.datetime(2015, 1, 1)
+        rollup = dict(self.rollup, Functions=['sum'])
+        del rollup['MetricName']
+        aggregator = leadbutt.Aggregator([rollup])
+        for metric_name, value in [('IncomingBytes', 50.0), ('OutgoingBytes', 1e6),
+                                   ('IncomingBytes', 25.0)]:
+            aggregator.observe([{'Timestamp': timestamp, 'Unit': 'Bytes', 'Sum': value}],
+                               dict(self.shard_metric('a', '1'), MetricName=metric_name))
+        lines = []
+        aggregator.output(lines.append)
+        self.assertEqual(lines, [
+            'cloudwatch.aws.kinesis.a.incomingbytes.sum.sum 75.0 1420070400\n',
+            'cloudwatch.aws.kinesis.a.outgoingbytes.sum.sum 1000000.0 1420070400\n',
+        ])
+
+    derived = {
+        'Name': 'error_rate',
+        'Namespace': 'AWS/ELB',
+        'GroupBy': ['LoadBalancerName'],
+        'Series': {
+            'errors': {'MetricName': 'HTTPCode_Backend_5XX', 'Statistic': 'Sum'},
+            'requests': {'MetricName': 'RequestCount', 'Statistic': 'Sum'},
+        },
+        'Expression': 'errors / requests * 100',
+    }
+
+    def elb_metric(self, metric_name, name='web'):
+        return {
+            'Namespace': 'AWS/ELB',
+            'MetricName': metric_name,
+            'Statistics': 'Sum',
+            'Dimensions': {'LoadBalancerName': name},
+        }
+
+    def test_derived_expressions_are_checked(self):
+        for expression in ['errors / other', '__import__("os")', 'errors.real', 'rate(errors, n=1)',
+                           '"a"', 'max(errors)', 'min(errors, errors, 1)', 'moving_average(errors)',
+                           'moving_average(errors, errors)', 'moving_average(errors, 1.5)',
+                           'errors + rate']:
+            with self.assertRaises(ValueError):
+                leadbutt.compile_expression(expression, ['errors'])
+        leadbutt.compile_expression('-moving_average(errors, 3) ** 2 + 1.5', ['errors'])
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def test_derived_lines_up_series_by_timestamp(self):
+        aggregator = leadbutt.Aggregator([], [self.derived])
+
+        def sums(values):
+            return [{'Timestamp': datetime.datetime(2015, 1, 1, 0, x), 'Sum': value}
+                    for x, value in values]
+
+        aggregator.observe(sums([(0, 1.0), (1, 0.0), (2, 3.0)]),
+                           self.elb_metric('HTTPCode_Backend_5XX'))
+        # the second minute has no requests and the third isn't there at all
+        self.assertFalse(aggregator.observe(sums([(0, 10.0), (1, 0.0)]),
+                                            self.elb_metric('RequestCount')))
+        lines = []
+        aggregator.output(lines.append)
+        self.assertEqual(lines, ['cloudwatch.aws.elb.web.error_rate 10.0 1420070400\n'])
+
+        derived = dict(self.derived, Expression='rate(requests)', Fill=0)
+        aggregator = leadbutt.Aggregator([], [derived])
+        aggregator.observe(sums([(0, 60.0), (2, 180.0)]), self.elb_metric('RequestCount'))
+        aggregator.observe(sums([(1, 1.0)]), self.elb_metric('HTTPCode_Backend_5XX'))
+        lines = []
+        aggregator.output(lines.append)
+        self.assertEqual(lines, [
+            'cloudwatch.aws.elb.web.error_rate -1.0 1420070460\n',
+            'cloudwatch.aws.elb.web.error_rate 3.0 1420070520\n',
+        ])
+
+
+class ProcessLogResultsTest(unittest.TestCase):
+    processes = [
+        {'name': 'postgres', 'id': 1, 'cpuUsedPc': 5.0, 'rss': 10},
+        {'name': 'kworker/0', 'id': 2, 'cpuUsedPc': 50.0, 'rss': 1},
+        {'name': 'bash', 'id': 3, 'cpuUsedPc': 1.0, 'rss': 2},
+        {'name': 'sshd', 'id': 4, 'cpuUsedPc': 2.0, 'rss': 3},
+    ]
+
+    def test_list_categories_can_be_cut_down(self):
+        entries = leadbutt.select_list_entries(self.processes, 'name', {
+            'Deny': ['kworker*'], 'Top': 1, 'By': 'cpuUsedPc', 'Other': True})
+        self.assertEqual(entries,
+                         [self.processes[0], {'name': 'other', 'cpuUsedPc': 3.0, 'rss': 5}])
+        entries = leadbutt.select_list_entries(self.processes, 'name',
+                                               {'Allow': ['postgres', 'b*']})
+        self.assertEqual([entry['name'] for entry in entries], ['postgres', 'bash'])
+        # a single pattern doesn't have to be in a list
+        entries = leadbutt.select_list_entries(self.processes, 'name',
+                                               {'Allow': 'postgres*', 'Deny': 'sshd'})
+        self.assertEqual([entry['name'] for entry in entries], ['postgres'])
+        self.assertIs(leadbutt.select_list_entries(self.processes, 'name', None), self.processes)
+
+    def test_list_controls_are_checked_up_front(self):
+        leadbutt.check_list_controls({'processList': {'Top': 5, 'By': 'cpuUsedPc'},
+                                      'diskIO': {'Deny': 'loop*'}})
+        for lists in ({'processList': {'Top': 5}}, {'processList': {'Top': '5', 'By': 'rss'}},
+                      {'processes': {}}):
+            with self.assertRaises(ValueError):
+                leadbutt.check_list_controls(lists)
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_runner_refuses_bad_list_controls(self, mock_get_config, mock_connect):
+        mock_get_config.return_value = {'Metrics': [], 'EnhancedMonitoring': {
+            'LogGroup': 'RDSOSMetrics', 'Lists': {'processList': {'Top': 5}}}}
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5})
+
+    def test_process_log_results(self):
+        message = {'instanceID': 'db-1', 'memory': {'total': 512}, 'processList': self.processes}
+        options = {
+            'Formatter': '%(dimension)s.%(MetricName)s.%(statistic)s',
+            'ListFormatter': '%(dimension)s.%(MetricName)s.%(ListCategory)s.%(statistic)s',
+            'Lists': {'processList': {'Top': 1, 'By': 'cpuUsedPc'}},
+        }
+        lines = []
+        leadbutt.process_log_results([{'message': json.dumps(message), 'timestamp': 1420070400000}],
+                                     options, lines.append)
+        self.assertEqual(sorted(line.split()[0] for line in lines), [
+            'db-1.memory.total',
+            'db-1.processlist.kworker.0.cpuusedpc',
+            'db-1.processlist.kworker.0.id',
+            'db-1.processlist.kworker.0.rss',
+        ])
+        # callers that don't know about Lists get every entry
+        del options['Lists']
+        lines = []
+        leadbutt.process_log_results([{'message': json.dumps(message), 'timestamp': 1420070400000}],
+                                     options, lines.append)
+        self.assertEqual(len(lines), 1 + 3 * len(self.processes))
+
+
+class PollScheduleTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_file = os.path.join(directory, 'state.json')
+
+    def results(self, *minutes):
+        return [{'Timestamp': datetime.datetime(2015, 1, 1, 0, x), 'Sum': 1.0} for x in minutes]
+
+    def test_empty_series_back_off_up_to_the_max(self):
+        schedule = leadbutt.PollSchedule(self.state_file, max_backoff=600)
+        now = 1420070400
+        for wait in (120, 240, 480, 600, 600):
+            schedule.observe('key', [], 60, now=now)
+            self.assertFalse(schedule.due('key', now=now + wait - 1))
+            self.assertTrue(schedule.due('key', now=now + wait))
+
+    def test_learns_cadence_and_persists_it(self):
+        schedule = leadbutt.PollSchedule(self.state_file)
+        now = 1420070400 + 12 * 60
+        # five minute datapoints, polled with a one minute period
+        schedule.observe('key', self.results(0, 5, 10), 60, now=now)
+        schedule.save()
+
+        schedule = leadbutt.PollSchedule(self.state_file)
+        self.assertEqual(schedule.state['key']['cadence'], 300)
+        self.assertEqual(schedule.since('key'), 1420070400 + 10 * 60)
+        self.assertFalse(schedule.due('key', now=now + 60))
+        self.assertTrue(schedule.due('key', now=1420070400 + 16 * 60))
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_runner_skips_queries_that_are_not_due(self, mock_get_config, mock_connect, mock_sleep):
+        mock_get_config.return_value = {'Metrics': [{
+            'Namespace': 'AWS/SQS',
+            'MetricName': 'NumberOfMessagesSent',
+            'Statistics': 'Sum',
+            'Dimensions': {'QueueName': 'idle'},
+        }]}
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 5, 'Period': 1},
+                                 adaptive=self.state_file)
+        runner.run()
+        runner.run()
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 1)
+
+
+class RevisionTrackerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state_file = os.path.join(directory, 'revisions.json')
+
+    def result(self, minute, value):
+        return {'Timestamp': datetime.datetime(2015, 1, 1, 0, minute), 'Sum': value}
+
+    def test_only_new_and_changed_datapoints_are_revised(self):
+        oldest = 1420070400
+        revisions = leadbutt.RevisionTracker(self.state_file)
+        results = [self.result(0, 1.0), self.result(1, 2.0)]
+        self.assertEqual(len(revisions.revise('key', results, oldest)), 2)
+        revisions.save()
+
+        revisions = leadbutt.RevisionTracker(self.state_file)
+        results = [self.result(0, 1.0), self.result(1, 3.0), self.result(2, 1.0)]
+        self.assertEqual(revisions.revise('key', results, oldest), results[1:])
+        self.assertEqual(revisions.revise('key', results, oldest), [])
+        # datapoints that won't be fetched again are forgotten
+        revisions.revise('key', [], oldest + 120)
+        self.assertEqual(list(revisions.state['key']), [str(oldest + 120)])
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_early_runner_includes_the_current_period(self, mock_get_config, mock_connect,
+                                                      mock_sleep):
+        mock_get_config.return_value = {'Metrics': [{
+            'Namespace': 'AWS/ELB',
+            'MetricName': 'RequestCount',
+            'Statistics': 'Sum',
+            'Dimensions': {'LoadBalancerName': 'frontend'},
+        }]}
+        now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+        results = [{'Timestamp': now, 'Sum': 1.0}]
+        mock_connect.return_value.get_metric_statistics.return_value = results
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 5, 'Period': 1}, early=True)
+        with mock.patch('leadbutt.output_results') as mock_output_results:
+            runner.run()
+            runner.run()
+        self.assertEqual(mock_output_results.call_args_list[0][0][0], results)
+        self.assertEqual(mock_output_results.call_args_list[1][0][0], [])
+        call_kwargs = mock_connect.return_value.get_metric_statistics.call_args[1]
+        self.assertGreater(call_kwargs['end_time'], datetime.datetime.utcnow())
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def query(self, count, **kwargs):
+        end_time = datetime.datetime(2015, 1, 1, 1, 0)
+        query = {
+            'period': 60,
+            'start_time': end_time - datetime.timedelta(minutes=count),
+            'end_time': end_time,
+            'metric_name': 'CPUUtilization',
+            'namespace': 'AWS/EC2',
+            'statistics': 'Average',
+            'dimensions': {'InstanceId': 'i-r0b0t'},
+        }
+        query.update(kwargs)
+        return query
+
+    def test_covered_queries_are_hits(self):
+        cache = leadbutt.ResponseCache()
+        fetch = mock.Mock(return_value=[
+            {'Timestamp': datetime.datetime(2015, 1, 1, 0, 50 + x), 'Average': x}
+            for x in range(10)])
+        self.assertEqual(len(cache.fetch('scope', fetch, **self.query(10))), 10)
+        self.assertEqual(len(cache.fetch('scope', fetch, **self.query(5))), 5)
+        cache.fetch('other scope', fetch, **self.query(5))
+        cache.fetch('scope', fetch, **self.query(20))
+        cache.fetch('scope', fetch, **self.query(5, statistics='Maximum'))
+        self.assertEqual(fetch.call_count, 4)
+        self.assertEqual(cache.stats(), {'entries': 3, 'hits': 1, 'misses': 4, 'evictions': 0})
+
+    def test_eviction_and_expiry(self):
+        cache = leadbutt.ResponseCache(max_entries=1, ttl=60)
+        fetch = mock.Mock(return_value=[])
+        cache.fetch('scope', fetch, **self.query(5))
+        cache.fetch('scope', fetch, **self.query(5, metric_name='NetworkIn'))
+        cache.fetch('scope', fetch, **self.query(5))
+        self.assertEqual(cache.stats()['evictions'], 2)
+        with mock.patch('leadbutt.time.time', return_value=time.time() + 61):
+            cache.fetch('scope', fetch, **self.query(5))
+        self.assertEqual(fetch.call_count, 4)
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_config_files_share_fetches(self, mock_get_config, mock_connect, mock_sleep):
+        metric = {
+            'Namespace': 'AWS/EC2',
+            'MetricName': 'CPUUtilization',
+            'Statistics': 'Average',
+            'Dimensions': {'InstanceId': 'i-r0b0t'},
+        }
+        mock_get_config.side_effect = lambda path: {
+            'team-a.yaml': {'Metrics': [metric]},
+            'team-b.yaml': {'Metrics': [metric], 'Options': {'Formatter': 'team_b.%(MetricName)s'}},
+        }[path]
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        cache = leadbutt.ResponseCache()
+        self.assertTrue(leadbutt.leadbutt(['team-a.yaml', 'team-b.yaml'], {'Count': 5, 'Period': 1},
+                                          cache=cache))
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 1)
+        self.assertEqual(cache.hits, 1)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_connections_are_reused_per_key(self):
+        connect = mock.Mock(side_effect=lambda region, **kwargs: object())
+        pool = leadbutt.ConnectionPool()
+        with pool.connection(connect, 'us-east-1') as first:
+            with pool.connection(connect, 'us-east-1') as second:
+                self.assertIsNot(first, second)
+        with pool.connection(connect, 'us-east-1') as conn:
+            self.assertIn(conn, (first, second))
+        with pool.connection(connect, 'us-east-1', aws_access_key_id='foo') as conn:
+            self.assertNotIn(conn, (first, second))
+        self.assertEqual(connect.call_count, 3)
+
+    def test_size_is_bounded(self):
+        pool = leadbutt.ConnectionPool(max_size=1)
+        connect = mock.Mock()
+        conn = pool.get(connect, 'us-east-1')
+        borrowed = []
+        thread = threading.Thread(target=lambda: borrowed.append(pool.get(connect, 'us-east-1')))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(borrowed, [])
+        pool.put(conn, connect, 'us-east-1')
+        thread.join()
+        self.assertEqual(borrowed, [conn])
+
+
+class FakeCloudWatchHandler(BaseHTTPRequestHandler):
+    """Answers every GetMetricStatistics with the same two datapoints."""
+    protocol_version = 'HTTP/1.1'
+    response = (
+        '<GetMetricStatisticsResponse xmlns="http://monitoring.amazonaws.com/doc/2010-08-01/">'
+        '<GetMetricStatisticsResult><Datapoints>'
+        '<member><Timestamp>2015-01-01T00:00:00Z</Timestamp><Unit>Percent</Unit>'
+        '<Average>12.5</Average></member>'
+        '<member><Timestamp>2015-01-01T00:01:00Z</Timestamp><Unit>Percent</Unit>'
+        '<Average>25.0</Average></member>'
+        '</Datapoints><Label>CPUUtilization</Label></GetMetricStatisticsResult>'
+        '</GetMetricStatisticsResponse>'
+    ).encode('utf-8')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.client_address, self.headers['Authorization'], body))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.response)))
+        self.end_headers()
+        self.wfile.write(self.response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@unittest.skipUnless(sys.version_info >= (3, 5), 'the asyncio engine needs Python 3.5+')
+class AsyncEngineTest(unittest.TestCase):
+    def test_sign_matches_the_aws_test_suite(self):
+        import leadbutt_async
+
+        # get-vanilla from the AWS Signature Version 4 test suite
+        headers = leadbutt_async.sign(
+            'GET', 'https://example.amazonaws.com/', {}, b'', 'us-east-1', 'service',
+            ('AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', None),
+            now=datetime.datetime(2015, 8, 30, 12, 36))
+        self.assertEqual(headers['Authorization'], (
+            'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, '
+            'SignedHeaders=host;x-amz-date, '
+            'Signature=5fa00fa31553b73ebf1942676e86291e8372ff2a2260956d9b8aae1d763fbf31'))
+
+    @mock.patch('leadbutt.get_config')
+    def test_fetches_from_a_fake_endpoint(self, mock_get_config):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCloudWatchHandler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        mock_get_config.return_value = {
+            'Auth': {'region': 'us-west-2', 'aws_access_key_id': 'foo',
+                     'aws_secret_access_key': 'bar'},
+            'Metrics': [{
+                'Namespace': 'AWS/EC2',
+                'MetricName': 'CPUUtilization',
+                'Statistics': 'Average',
+                'Dimensions': {'InstanceId': 'i-{0}'.format(x)},
+            } for x in range(50)],
+        }
+        output = mock.Mock()
+        self.assertTrue(leadbutt.leadbutt(
+            'dummy_config_file', {'Count': 5, 'Period': 1}, engine='asyncio', in_flight=10,
+            output=output,
+            endpoints={'monitoring': 'http://127.0.0.1:{0}/'.format(server.server_address[1])}))
+
+        self.assertEqual(len(server.requests), 50)
+        self.assertTrue(all(authorization.startswith('AWS4-HMAC-SHA256 Credential=foo/')
+                            for client, authorization, body in server.requests))
+        self.assertTrue(any(b'Dimensions.member.1.Value=i-49' in body
+                            for client, authorization, body in server.requests))
+        # connections are kept alive, and there are no more than in flight
+        self.assertLessEqual(
+            len(set(client for client, authorization, body in server.requests)), 10)
+        lines = sorted(call[0][0] for call in output.write.call_args_list)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(lines[0],
+                         'cloudwatch.aws.ec2.i-0.cpuutilization.average.percent 12.5 1420070400\n')
+
+
+class CaptureTest(unittest.TestCase):
+    metric = {
+        'Namespace': 'AWS/ELB',
+        'MetricName': 'RequestCount',
+        'Statistics': 'Sum',
+        'Dimensions': {'LoadBalancerName': 'frontend'},
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_replay_reformats_captured_responses(self, mock_get_config, mock_connect, mock_sleep):
+        mock_get_config.return_value = {'Metrics': [self.metric]}
+        mock_connect.return_value.get_metric_statistics.return_value = [
+            {'Timestamp': datetime.datetime(2015, 1, 1, 0, x), 'Sum': float(x), 'Unit': 'Count'}
+            for x in range(3)]
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 5, 'Period': 1},
+                                 capture=self.directory)
+        runner.run()
+        runner.run()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        mock_get_config.return_value = {'Metrics': [self.metric],
+                                        'Options': {'Formatter': 'elb.%(dimension)s'}}
+        mock_connect.reset_mock()
+        output = mock.Mock()
+        leadbutt.replay(self.directory, 'dummy_config_file', {'Count': 5, 'Period': 1},
+                        output=output)
+        self.assertFalse(mock_connect.called)
+        lines = [call[0][0] for call in output.write.call_args_list]
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0], 'elb.frontend 0.0 1420070400\n')
+
+
+class RunCoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+
+    def test_skip_while_locked(self):
+        first = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        self.assertTrue(first.acquire())
+        self.assertFalse(leadbutt.RunCoordinator('config.yaml', self.lock_dir).acquire())
+        # other configs and shards have locks of their own
+        self.assertTrue(
+            leadbutt.RunCoordinator('config.yaml', self.lock_dir, shard=(1, 2)).acquire())
+        first.release()
+        self.assertTrue(leadbutt.RunCoordinator('config.yaml', self.lock_dir).acquire())
+
+    def test_takeover_continues_where_the_old_run_stopped(self):
+        old = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        old.acquire()
+        old.complete('a')
+        new = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(new.acquire(takeover=True, timeout=5)))
+        thread.start()
+        while not old.superseded():
+            time.sleep(0.01)
+        old.release(done=False)
+        thread.join()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(new.completed, set(['a']))
+        self.assertEqual(new.took_over_from, os.getpid())
+        self.assertFalse(new.superseded())
+
+    def test_old_run_finishing_on_its_own_clears_the_handoff(self):
+        old = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        old.acquire()
+        new = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(new.acquire(takeover=True, timeout=5)))
+        thread.start()
+        while not old.superseded():
+            time.sleep(0.01)
+        # the old run gets to the end before it notices the handoff
+        old.release(done=True)
+        thread.join()
+        self.assertEqual(acquired, [True])
+        self.assertIsNone(new.took_over_from)
+        self.assertFalse(new.superseded())
+        new.release()
+        later = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        self.assertTrue(later.acquire())
+        self.assertFalse(later.superseded())
+
+    def test_stale_handoff_is_ignored(self):
+        coordinator = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        with open(coordinator.handoff_file, 'w') as fp:
+            fp.write('1\n')
+        os.utime(coordinator.handoff_file, (time.time() - 60, time.time() - 60))
+        self.assertTrue(coordinator.acquire())
+        self.assertFalse(coordinator.superseded())
+        self.assertFalse(os.path.exists(coordinator.handoff_file))
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_runner_skips_completed_queries(self, mock_get_config, mock_connect, mock_sleep):
+        mock_get_config.return_value = {'Metrics': [{
+            'Namespace': 'AWS/EC2',
+            'MetricName': ['CPUUtilization', 'NetworkIn'],
+            'Statistics': 'Maximum',
+            'Dimensions': {'InstanceId': 'i-r0b0t'},
+        }]}
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        coordinator = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        coordinator.acquire()
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 5, 'Period': 1},
+                                 coordinator=coordinator)
+        coordinator.completed.add(list(runner.queries)[0])
+        self.assertTrue(runner.run())
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 1)
+        self.assertEqual(coordinator.completed, set(runner.queries))
+
+    @mock.patch('leadbutt.time.sleep')
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_runner_that_took_over_skips_rollups(self, mock_get_config, mock_connect, mock_sleep):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/EC2',
+                'MetricName': 'CPUUtilization',
+                'Statistics': 'Maximum',
+                'Dimensions': {'InstanceId': instance},
+            } for instance in ('i-r0b0t', 'i-sh4rk')],
+            'Rollups': [{'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization',
+                         'Statistic': 'Maximum', 'Functions': ['max'], 'DropMembers': True}],
+        }
+        mock_connect.return_value.get_metric_statistics.return_value = [
+            {'Timestamp': datetime.datetime(2015, 1, 1), 'Unit': 'Percent', 'Maximum': 1.0}]
+        coordinator = leadbutt.RunCoordinator('config.yaml', self.lock_dir)
+        coordinator.acquire()
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 5, 'Period': 1},
+                                 coordinator=coordinator)
+        coordinator.completed.add(list(runner.queries)[0])
+        coordinator.took_over_from = 1
+        with mock.patch('sys.stdout') as mock_stdout, mock.patch('sys.stderr'):
+            self.assertTrue(runner.run())
+        self.assertFalse(mock_stdout.write.called)
+        coordinator.next_run()
+        with mock.patch('sys.stdout') as mock_stdout:
+            self.assertTrue(runner.run())
+        self.assertEqual(mock_stdout.write.call_count, 1)
+        self.assertIn('.max ', mock_stdout.write.call_args[0][0])
+
+
+class RunnerTest(unittest.TestCase):
+    metric = {
+        'Namespace': 'AWS/EC2',
+        'MetricName': ['CPUUtilization', 'NetworkIn'],
+        'Statistics': 'Maximum',
+        'Dimensions': {'InstanceId': 'i-r0b0t'},
+    }
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_reload_swaps_only_changed_queries(self, mock_get_config, mock_connect):
+        mock_get_config.return_value = {'Metrics': [self.metric]}
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5})
+        options = leadbutt.get_options(None, None, {'Count': 1, 'Period': 5})
+        key = leadbutt.query_key(dict(self.metric, MetricName='CPUUtilization'), options)
+        kept = runner.queries[key]
+
+        changed = dict(self.metric, MetricName=['CPUUtilization', 'NetworkOut'])
+        with mock.patch('leadbutt.load_config', return_value={'Metrics': [changed]}):
+            added, removed, changed = runner.reload()
+        self.assertEqual(len(added), 1)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(changed, [])
+        self.assertIs(runner.queries[key], kept)
+        # the connection is kept as long as Auth does not change
+        self.assertEqual(mock_connect.call_count, 1)
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_metrics_differing_only_in_statistics_or_formatter_are_both_queried(
+            self, mock_get_config, mock_connect):
+        latency = {'Namespace': 'AWS/ELB', 'MetricName': 'Latency', 'Statistics': 'Average',
+                   'Dimensions': {'LoadBalancerName': 'frontend'}}
+        mock_get_config.return_value = {'Metrics': [
+            latency,
+            dict(latency, Statistics='Maximum',
+                 Options={'Formatter': 'elb.%(dimension)s.latency.max'}),
+            dict(latency, Options={'Formatter': 'elb.%(dimension)s.latency'}),
+        ]}
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        runner = leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5})
+        self.assertEqual(len(runner.queries), 3)
+        runner.run()
+        statistics = [call[1]['statistics']
+                      for call in mock_connect.return_value.get_metric_statistics.call_args_list]
+        self.assertEqual(statistics, ['Average', 'Maximum', 'Average'])
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    def test_daemon_keeps_running_when_a_reload_fails(self, mock_connect):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config_file = os.path.join(directory, 'config.yaml')
+        with open(config_file, 'w') as fp:
+            json.dump({'Metrics': [self.metric]}, fp)
+        mock_connect.return_value.get_metric_statistics.return_value = []
+        handlers = {}
+        reloads = []
+
+        class Stop(Exception):
+            pass
+
+        def sleep(seconds):
+            if not seconds:
+                return  # between queries
+            if reloads:
+                raise Stop()
+            with open(config_file, 'w') as fp:
+                fp.write('Metrics: [')
+            reloads.append(seconds)
+            handlers[signal.SIGHUP](signal.SIGHUP, None)
+
+        def signal_handler(signum, handler):
+            handlers[signum] = handler
+
+        with mock.patch('leadbutt.signal.signal', side_effect=signal_handler), \
+                mock.patch('leadbutt.time.sleep', side_effect=sleep), \
+                mock.patch('sys.stderr') as mock_stderr, mock.patch('sys.stdout'):
+            with self.assertRaises(Stop):
+                leadbutt.daemon(config_file, {'Count': 1, 'Period': 5})
+        self.assertIn('could not reload',
+                      ''.join(call[0][0] for call in mock_stderr.write.call_args_list))
+        # both runs fetched both queries
+        self.assertEqual(mock_connect.return_value.get_metric_statistics.call_count, 4)
+
+
+class shardTest(unittest.TestCase):
+    keys = [leadbutt.query_key({'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization',
+                                'Dimensions': {'InstanceId': 'i-{0}'.format(x)}},
+                               leadbutt.DEFAULT_OPTIONS)
+            for x in range(1000)]
+
+    def test_adding_a_shard_moves_few_keys(self):
+        before = [leadbutt.get_shard(key, 4) for key in self.keys]
+        after = [leadbutt.get_shard(key, 5) for key in self.keys]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        # only keys won by the new shard move, about a fifth of them
+        self.assertTrue(all(new == 5 for old, new in moved))
+        self.assertLess(len(moved), 300)
+        self.assertEqual(set(before), set([1, 2, 3, 4]))
+
+    def test_parse_shard(self):
+        self.assertEqual(leadbutt.parse_shard('2/3'), (2, 3))
+        with self.assertRaises(ValueError):
+            leadbutt.parse_shard('0/3')
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_runner_only_loads_its_shard(self, mock_get_config, mock_connect):
+        mock_get_config.return_value = {'Metrics': [{
+            'Namespace': 'AWS/EC2',
+            'MetricName': 'CPUUtilization',
+            'Statistics': 'Maximum',
+            'Dimensions': {'InstanceId': 'i-{0}'.format(x)},
+        } for x in range(20)]}
+        shards = [leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5},
+                                  shard=(x, 3)).queries
+                  for x in (1, 2, 3)]
+        self.assertEqual(sum(len(x) for x in shards), 20)
+        self.assertFalse(set(shards[0]) & set(shards[1]))
+
+    @mock.patch('boto.ec2.cloudwatch.connect_to_region')
+    @mock.patch('leadbutt.get_config')
+    def test_rollup_groups_stay_in_one_shard(self, mock_get_config, mock_connect):
+        rollup = {'Namespace': 'AWS/Kinesis', 'MetricName': 'IncomingBytes', 'Statistic': 'Sum',
+                  'GroupBy': ['StreamName'], 'Functions': ['sum']}
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/Kinesis',
+                'MetricName': 'IncomingBytes',
+                'Statistics': 'Sum',
+                'Dimensions': {'StreamName': stream, 'ShardId': 'shardId-{0}'.format(x)},
+            } for stream in ('a', 'b', 'c', 'd') for x in range(8)],
+            'Rollups': [rollup],
+        }
+        shards = [leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5},
+                                  shard=(x, 2)).queries
+                  for x in (1, 2)]
+        self.assertEqual(sum(len(x) for x in shards), 32)
+        for queries in shards:
+            streams = set(metric['Dimensions']['StreamName']
+                          for metric, options in queries.values())
+            for stream in streams:
+                self.assertEqual(len([metric for metric, options in queries.values()
+                                      if metric['Dimensions']['StreamName'] == stream]), 8)
+
+        # a broader group takes in the narrower ones
+        mock_get_config.return_value['Rollups'].append(dict(rollup, GroupBy=[], Functions=['max']))
+        shards = [leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5},
+                                  shard=(x, 2)).queries
+                  for x in (1, 2)]
+        self.assertEqual(sorted(len(x) for x in shards), [0, 32])
+
+        # grouped two different ways, a metric can't be in one shard for both
+        mock_get_config.return_value['Rollups'][1]['GroupBy'] = ['ShardId']
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5}, shard=(1, 2))
+        # without --shard it doesn't matter
+        leadbutt.Runner('dummy_config_file', {'Count': 1, 'Period': 5})
+
+    def test_supervise_spools_merged_output(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        spool = leadbutt.Spool(directory)
+        output = leadbutt.SpoolingOutput(mock.Mock(side_effect=IOError('broken pipe')), spool)
+        command = [sys.executable, '-c', 'import sys; print(sys.argv[-1])']
+        self.assertEqual(leadbutt.supervise(command, 2, output=output), 0)
+        lines = []
+        spool.drain(lines.extend)
+        self.assertEqual(sorted(lines), ['1/2\n', '2/2\n'])
+
+    @mock.patch('leadbutt.supervise')
+    def test_serve_sink_is_refused_with_processes(self, mock_supervise):
+        argv = ['leadbutt', '--processes', '2', '--sink=serve://127.0.0.1:9108']
+        with mock.patch('sys.argv', argv), mock.patch('sys.stderr'), \
+                self.assertRaises(SystemExit) as e:
+            leadbutt.main()
+        self.assertEqual(e.exception.code, 2)
+        self.assertFalse(mock_supervise.called)
+
+    def test_shards_keep_state_in_files_of_their_own(self):
+        self.assertEqual(leadbutt.shard_path('/var/tmp/leadbutt.adaptive', None),
+                         '/var/tmp/leadbutt.adaptive')
+        self.assertEqual(leadbutt.shard_path('/var/tmp/leadbutt.adaptive', (2, 4)),
+                         '/var/tmp/leadbutt.adaptive.2-of-4')
+
+    def test_supervise_merges_output(self):
+        command = [sys.executable, '-c', 'import sys; print(sys.argv[-1])']
+        with mock.patch('sys.stdout') as mock_stdout:
+            status = leadbutt.supervise(command, 3)
+        self.assertEqual(status, 0)
+        lines = sorted(x[0][0] for x in mock_stdout.buffer.write.call_args_list)
+        self.assertEqual(lines, [b'1/3\n', b'2/3\n', b'3/3\n'])
+
+    def test_supervise_stops_restarting_on_sigterm(self):
+        # the first shard asks the supervisor to stop, as an init system would
+        command = [sys.executable, '-c', 'import os, signal, sys, time\n'
+                   'if sys.argv[-1] == "1/2": os.kill(os.getppid(), signal.SIGTERM)\n'
+                   'time.sleep(30)']
+        with mock.patch('sys.stdout'), mock.patch('sys.stderr') as mock_stderr:
+            status = leadbutt.supervise(command, 2, restart=True)
+        self.assertEqual(status, 128 + signal.SIGTERM)
+        self.assertFalse(mock_stderr.write.called)
+
+    def test_strip_option(self):
+        self.assertEqual(leadbutt.strip_option(['-v', '--processes', '4', '-n', '2'],
+                                               '--processes'),
+                         ['-v', '-n', '2'])
+        self.assertEqual(leadbutt.strip_option(['--processes=4', '-v'], '--processes'), ['-v'])
+
+
+class planTest(unittest.TestCase):
+    @mock.patch('leadbutt.get_config')
+    def test_plan_counts_calls_and_datapoints(self, mock_get_config):
+        mock_get_config.return_value = {
+            'Auth': {'region': 'us-west-2'},
+            'Metrics': [{
+                'Namespace': 'AWS/ELB',
+                'MetricName': ['RequestCount', 'Latency'],
+                'Statistics': ['Sum', 'Average'],
+                'Dimensions': {'LoadBalancerName': 'x'},
+            }, {
+                'Namespace': 'AWS/EC2',
+                'MetricName': 'CPUUtilization',
+                'Statistics': 'Maximum',
+                'Dimensions': {'InstanceId': 'i-r0b0t'},
+            }],
+        }
+        report = leadbutt.plan('dummy_config_file', {'Count': 5, 'Period': 1}, interval=50)
+        self.assertEqual(report['namespaces'][('AWS/ELB', 'us-west-2')],
+                         {'calls': 2, 'datapoints': 20})
+        self.assertEqual(report['namespaces'][('AWS/EC2', 'us-west-2')],
+                         {'calls': 1, 'datapoints': 5})
+        self.assertEqual(report['calls'], {'GetMetricStatistics': 3})
+        self.assertEqual(report['datapoints'], 25)
+        self.assertTrue(report['fits'])
+
+    @mock.patch('leadbutt.get_config')
+    def test_plan_flags_configs_that_overrun_the_period(self, mock_get_config):
+        mock_get_config.return_value = {
+            'Metrics': [{
+                'Namespace': 'AWS/EC2',
+                'MetricName': 'CPUUtilization',
+                'Statistics': 'Maximum',
+                'Dimensions': {'InstanceId': 'i-{0}'.format(x)},
+            } for x in range(1000)],
+        }
+        report = leadbutt.plan('dummy_config_file', {'Count': 5, 'Period': 1}, interval=50)
+        self.assertGreater(report['duration'], 60)
+        self.assertFalse(report['fits'])
+
+
 @unittest.skipUnless('TOX_TEST_ENTRYPOINT' in os.environ,
     'This is only applicable if leadbutt is installed')
 class mainTest(unittest.TestCase):
@@ -6,6 +6,12 @@ My class names are funny because I name them after the function they cover.
 """
 from __future__ import unicode_literals
 
+from subprocess import check_output
+import json
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 import mock
 
@@ -80,6 +86,61 @@ class FilterTests(unittest.TestCase):
         self.assertEqual(0, len(filtered_instances))
 
 
+class TagTests(unittest.TestCase):
+    def resources(self, *names):
+        resources = [mock.Mock(spec=['name', 'tags']) for name in names]
+        for resource, name in zip(resources, names):
+            resource.name = name
+        return resources
+
+    @mock.patch.dict(plumbum.tag_fetchers,
+                     {'fake': mock.Mock(return_value={'a': {'env': 'prod'}, 'b': {'env': 'dev'}})})
+    @mock.patch('plumbum.default_tag_cache', plumbum.TagCache())
+    def test_tags_are_fetched_together_when_first_used(self):
+        fetch = plumbum.tag_fetchers['fake']
+        resources = plumbum.attach_tags('fake', 'moo', self.resources('a', 'b', 'c'),
+                                        lambda r: r.name)
+        self.assertFalse(fetch.called)
+        self.assertEqual([r.name for r in plumbum.lookup(resources, {'env': 'prod'})], ['a'])
+        fetch.assert_called_once_with('moo', ['a', 'b', 'c'])
+        self.assertEqual(dict(resources[2].tags), {})
+
+        # a new listing reuses the tags until they expire
+        resources = plumbum.attach_tags('fake', 'moo', self.resources('a', 'b', 'c'),
+                                        lambda r: r.name)
+        self.assertEqual(resources[1].tags['env'], 'dev')
+        self.assertEqual(fetch.call_count, 1)
+        plumbum.default_tag_cache.ttl = 0
+        resources = plumbum.attach_tags('fake', 'moo', self.resources('a'), lambda r: r.name)
+        self.assertEqual(resources[0].tags.get('env'), 'prod')
+        self.assertEqual(fetch.call_count, 2)
+
+    @mock.patch('plumbum.ELB_TAG_BATCH_SIZE', 2)
+    @mock.patch('boto.ec2.elb.connect_to_region')
+    def test_elb_tags_are_fetched_in_batches(self, mock_connect):
+        conn = mock_connect.return_value
+        conn.build_list_params.side_effect = lambda params, items, label: params.update(
+            ('{0}.{1}'.format(label, i), item) for i, item in enumerate(items, 1))
+        conn.make_request.return_value.status = 200
+        conn.make_request.return_value.read.side_effect = [
+            b'<DescribeTagsResponse '
+            b'xmlns="http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/">'
+            b'<DescribeTagsResult><TagDescriptions><member><LoadBalancerName>a</LoadBalancerName>'
+            b'<Tags><member><Key>env</Key><Value>prod</Value></member></Tags></member>'
+            b'<member><LoadBalancerName>b</LoadBalancerName><Tags/></member>'
+            b'</TagDescriptions></DescribeTagsResult></DescribeTagsResponse>',
+            b'<DescribeTagsResponse><DescribeTagsResult><TagDescriptions/>'
+            b'</DescribeTagsResult></DescribeTagsResponse>',
+        ]
+        self.assertEqual(plumbum.fetch_elb_tags('moo', ['a', 'b', 'c']),
+                         {'a': {'env': 'prod'}, 'b': {}})
+        self.assertEqual(conn.make_request.call_args_list, [
+            mock.call('DescribeTags', {'LoadBalancerNames.member.1': 'a',
+                                       'LoadBalancerNames.member.2': 'b'}),
+            mock.call('DescribeTags', {'LoadBalancerNames.member.1': 'c'}),
+        ])
+
+
 class ListXXXTests(unittest.TestCase):
     @mock.patch('boto.elasticache.connect_to_region')
     def test_list_elasticache_trivial_case(self, mock_boto):
@@ -99,5 +160,144 @@ class ListXXXTests(unittest.TestCase):
         self.assertEqual(tables, [])
 
 
+class TemplateCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.template = os.path.join(self.tmpdir, 'test.yml.j2')
+        with open(self.template, 'w') as fp:
+            fp.write('region: {{ region }}{% for r in resources %} {{ r }}{% endfor %}')
+
+    @mock.patch.dict(plumbum._jinja_environments, clear=True)
+    def test_templates_are_compiled_once_and_cached_on_disk(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        template = plumbum.get_jinja_template(self.template, cache_dir)
+        self.assertIs(plumbum.get_jinja_template(self.template, cache_dir), template)
+        self.assertTrue(os.listdir(cache_dir))
+
+    @mock.patch.dict(plumbum.list_resources, {'fake': mock.Mock(return_value=['a', 'b'])})
+    def test_manifest_shares_inventory(self):
+        outputs = [os.path.join(self.tmpdir, name) for name in ('one.yml', 'two.yml', 'three.yml')]
+        manifest = os.path.join(self.tmpdir, 'manifest.yml')
+        with open(manifest, 'w') as fp:
+            json.dump([
+                {'template': self.template, 'namespace': 'AWS/Fake', 'output': outputs[0]},
+                {'template': self.template, 'namespace': 'fake', 'output': outputs[1]},
+                {'template': self.template, 'namespace': 'fake', 'region': 'us-west-2',
+                 'output': outputs[2]},
+            ], fp)
+        plumbum.render_manifest(manifest)
+        self.assertEqual(plumbum.list_resources['fake'].call_count, 2)
+        with open(outputs[0]) as fp:
+            self.assertEqual(fp.read(), 'region: us-east-1 a b\n')
+        with open(outputs[2]) as fp:
+            self.assertEqual(fp.read(), 'region: us-west-2 a b\n')
+
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.template = os.path.join(self.tmpdir, 'test.yml.j2')
+        self.output = os.path.join(self.tmpdir, 'test.yml')
+        with open(self.template, 'w') as fp:
+            fp.write('Metrics:\n{% for r in resources %}'
+                     '- {Namespace: AWS/EC2, MetricName: CPUUtilization, Statistics: Sum, '
+                     'Dimensions: {InstanceId: {{ r }}}}\n{% endfor %}')
+
+    @mock.patch('plumbum.time.sleep')
+    @mock.patch('plumbum.signal_reload')
+    def test_rewrites_and_signals_only_when_metrics_change(self, mock_signal, mock_sleep):
+        lister = mock.Mock(side_effect=[['i-1'], ['i-1'], ['i-1', 'i-2']])
+        with mock.patch.dict(plumbum.list_resources, {'fake': lister}):
+            plumbum.watch(self.template, 'fake', 'us-east-1', {}, None, self.output, 60,
+                          pid_file='leadbutt.pid', polls=2)
+            self.assertEqual(mock_signal.call_count, 1)
+            plumbum.watch(self.template, 'fake', 'us-east-1', {}, None, self.output, 60,
+                          pid_file='leadbutt.pid', polls=1)
+        self.assertEqual(mock_signal.call_count, 2)
+        with open(self.output) as fp:
+            self.assertIn('i-2', fp.read())
+
+    @mock.patch('plumbum.time.sleep')
+    @mock.patch('plumbum.signal_reload')
+    def test_a_failed_poll_is_retried(self, mock_signal, mock_sleep):
+        with open(self.output, 'w') as fp:
+            fp.write('Metrics: []\n')
+        os.chmod(self.output, 0o644)
+        lister = mock.Mock(side_effect=[IOError('connection reset'), ['i-1']])
+        with mock.patch.dict(plumbum.list_resources, {'fake': lister}), mock.patch('sys.stderr'):
+            plumbum.watch(self.template, 'fake', 'us-east-1', {}, None, self.output, 60, polls=2)
+        with open(self.output) as fp:
+            self.assertIn('i-1', fp.read())
+        # leadbutt may run as another user, so the mode is kept
+        self.assertEqual(os.stat(self.output).st_mode & 0o777, 0o644)
+
+    def test_json_lines_have_the_same_metrics(self):
+        config = ('Auth:\n  region: us-west-2\nMetrics:\n'
+                  '- {Namespace: AWS/EC2, MetricName: A, Statistics: Sum, Dimensions: {X: y}}\n'
+                  '- {Namespace: AWS/EC2, MetricName: B, Statistics: Sum, Dimensions: {X: y}}\n')
+        json_lines = plumbum.to_json_lines(config)
+        self.assertEqual(len(json_lines.splitlines()), 3)
+        self.assertEqual(json.loads(json_lines.splitlines()[0]), {'Auth': {'region': 'us-west-2'}})
+        self.assertEqual(plumbum.metric_set(json_lines), plumbum.metric_set(config))
+
+    def test_metric_set_ignores_formatting(self):
+        one = ('Metrics:\n'
+               '- {Namespace: AWS/EC2, MetricName: [A, B], Statistics: Sum, Dimensions: {X: y}}\n')
+        two = ('Metrics:\n- Namespace: AWS/EC2\n  Statistics: Sum\n  MetricName:\n  - A\n  - B\n'
+               '  Dimensions:\n    X: y\n')
+        self.assertEqual(plumbum.metric_set(one), plumbum.metric_set(two))
+        # what Python 2 reads from a file
+        self.assertEqual(plumbum.metric_set(one.encode('utf-8')), plumbum.metric_set(one))
+
+
+class GetListerTests(unittest.TestCase):
+    def test_builtin_lister(self):
+        self.assertEqual(plumbum.get_lister('ec2'), plumbum.list_ec2)
+
+    def test_unknown_namespace_raises_key_error(self):
+        with mock.patch('leadbutt.iter_entry_points', return_value=[]):
+            with self.assertRaises(KeyError):
+                plumbum.get_lister('nope')
+
+    def test_entry_point_lister(self):
+        entry_point = mock.Mock()
+        entry_point.name = 'custom'
+        with mock.patch('leadbutt.iter_entry_points', return_value=[entry_point]):
+            with mock.patch.dict(plumbum.list_resources):
+                lister = plumbum.get_lister('custom')
+        self.assertEqual(lister, entry_point.load.return_value)
+
+
+class StartupTests(unittest.TestCase):
+    # importing every boto service up front used to dominate startup time, and
+    # these only get imported by the commands, sinks and engines that need them
+    heavy_modules = ['asyncio', 'boto', 'email', 'gzip', 'http.client', 'http.server',
+                     'multiprocessing', 'numpy', 'socket', 'ssl', 'subprocess', 'urllib.request',
+                     'xml.etree']
+    script = 'import sys, json; {0}; print(json.dumps(sorted(sys.modules)))'
+
+    def imported(self, imports):
+        output = check_output([sys.executable, '-c', self.script.format(imports)])
+        return json.loads(output.decode('utf-8'))
+
+    def test_importing_does_not_import_boto_services(self):
+        modules = self.imported('import leadbutt, plumbum, plumblead')
+        self.assertNotIn('boto.logs', modules)
+        self.assertNotIn('boto.rds', modules)
+        self.assertNotIn('boto.ec2.cloudwatch', modules)
+
+    def test_importing_does_not_import_heavy_modules(self):
+        # only check what this package imports: some versions of the
+        # dependencies import a few of these themselves, like jinja2 2.x
+        # importing socket on Python 2
+        dependencies = self.imported('import docopt, jinja2, retrying, yaml')
+        heavy_modules = [module for module in self.heavy_modules if module not in dependencies]
+        for imports in ('import leadbutt', 'import plumbum, plumblead'):
+            modules = self.imported(imports)
+            self.assertEqual([module for module in heavy_modules if module in modules], [], imports)
+
+
 if __name__ == '__main__':
     unittest.main()